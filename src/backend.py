@@ -0,0 +1,114 @@
+import json
+import openai
+import threading
+import time
+
+# Chat API requests go through a backend: the live API, a recorder wrapping
+# another backend, or a replayer that answers from a recording without any
+# network access.
+
+class LiveBackend:
+    def chat_completion(self, **args):
+        return openai.ChatCompletion.create(**args)
+
+class ReplayError(Exception):
+    pass
+
+def request_key(args):
+    """Identifies a request by everything that affects its response."""
+    return json.dumps({k: v for (k, v) in args.items() if k != "request_timeout"}, sort_keys=True)
+
+class RecordingBackend:
+    """
+    Passes requests to another backend and appends each complete response
+    to a JSONL file, along with the request and the time each chunk arrived.
+    """
+    def __init__(self, path, backend=None):
+        self.path = path
+        self.backend = backend or LiveBackend()
+        self.lock = threading.Lock()
+
+    def chat_completion(self, **args):
+        started = time.monotonic()
+        response = self.backend.chat_completion(**args)
+        if not args.get("stream"):
+            self.write(args, [[time.monotonic() - started, response.to_dict_recursive()]])
+            return response
+        return self.record_stream(args, started, response)
+
+    def record_stream(self, args, started, stream):
+        chunks = []
+        try:
+            for chunk in stream:
+                chunks.append([time.monotonic() - started, chunk.to_dict_recursive()])
+                yield chunk
+        finally:
+            stream.close()
+            # A response the caller stopped reading early can't be replayed.
+            if chunks and chunks[-1][1]["choices"][0].get("finish_reason"):
+                self.write(args, chunks)
+
+    def write(self, args, chunks):
+        request = {k: v for (k, v) in args.items() if k != "request_timeout"}
+        line = json.dumps({"request": request, "chunks": chunks})
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+def read_recording(path):
+    """Yields (request, chunks) from a file written by RecordingBackend."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield (record["request"], record["chunks"])
+
+class ReplayBackend:
+    """
+    Answers requests from a file written by RecordingBackend. With realtime,
+    chunks arrive with their recorded timing. Otherwise they come as fast as
+    possible, which leaves only the client's own overhead. A request
+    recorded more than once gets its responses in order, and then the last
+    one again.
+    """
+    def __init__(self, path, realtime=True):
+        self.realtime = realtime
+        self.responses = {}
+        self.replays = {}
+        self.lock = threading.Lock()
+        for (request, chunks) in read_recording(path):
+            self.responses.setdefault(request_key(request), []).append(chunks)
+
+    def chat_completion(self, **args):
+        key = request_key(args)
+        with self.lock:
+            recordings = self.responses.get(key)
+            if not recordings:
+                raise ReplayError("No recorded response for this request")
+            n = self.replays.get(key, 0)
+            self.replays[key] = n + 1
+        chunks = recordings[min(n, len(recordings) - 1)]
+        if not args.get("stream"):
+            (offset, response) = chunks[0]
+            if self.realtime:
+                time.sleep(offset)
+            return openai.openai_object.OpenAIObject.construct_from(response)
+        return self.replay(chunks)
+
+    def replay(self, chunks):
+        started = time.monotonic()
+        for (offset, chunk) in chunks:
+            if self.realtime:
+                delay = offset - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            yield openai.openai_object.OpenAIObject.construct_from(chunk)
+
+backend = LiveBackend()
+
+def set_backend(new_backend):
+    global backend
+    backend = new_backend
+
+def chat_completion(**args):
+    return backend.chat_completion(**args)
@@ -1,12 +1,21 @@
 import simplejson
+import asyncio
+import concurrent.futures
+from contextlib import aclosing
+from dataclasses import dataclass, field
 import enum
+import functools
+import hashlib
 import inspect
 import openai
+import random
 import sys
 import threading
 import time
 import typing
-from src.spin import spin
+from src import backend
+from src.http_session import TIMEOUT
+from src.spin import spin, spin_async
 
 def get_json_type_name(value):
     if isinstance(value, str):
@@ -75,8 +84,41 @@ def _json_schema(func):
 
     return api_info
 
-def create_chat_with_spinner(messages, temperature, functions, model):
-    return create_chat(messages, temperature, functions, model, True)
+@dataclass
+class Tool:
+    func: typing.Callable
+    schema: dict
+    # A sloppy tool receives arguments that aren't valid JSON verbatim as its
+    # first parameter, since models sometimes send raw code instead of JSON.
+    sloppy: bool
+    # A parallel tool never prompts the user, so it can run alongside others.
+    parallel: bool
+    num_params: int
+
+# Tools the model may call, by name.
+TOOLS = {}
+
+def tool(sloppy=False, parallel=False):
+    """Decorator that registers a function as a tool. Its schema is computed once, here."""
+    def register(func):
+        TOOLS[func.__name__] = Tool(func, _json_schema(func), sloppy, parallel, len(inspect.signature(func).parameters))
+        return func
+    return register
+
+@functools.lru_cache(maxsize=None)
+def tool_schemas(names):
+    """Returns the list of schemas for a tuple of tool names. The same list is reused for every request."""
+    return [TOOLS[name].schema for name in names]
+
+@functools.lru_cache(maxsize=None)
+def tool_specs(names):
+    """Like tool_schemas, in the form the tools request parameter takes."""
+    return [{"type": "function", "function": schema} for schema in tool_schemas(names)]
+
+def find_tool(functions, name):
+    if name not in functions or name not in TOOLS:
+        raise ValueError(f"Function '{name}' not found.")
+    return TOOLS[name]
 
 def create_chat(messages, temperature, functions, model, spinner=False, stream=True):
     def create_chat_model():
@@ -85,10 +127,11 @@ def create_chat(messages, temperature, functions, model, spinner=False, stream=T
             "messages": messages,
             "stream": stream,
             "temperature": temperature,
+            "request_timeout": TIMEOUT,
         }
         if functions:
-            args['functions'] = list(map(lambda f: _json_schema(f), functions))
-        return openai.ChatCompletion.create(**args)
+            args['tools'] = tool_specs(functions)
+        return backend.chat_completion(**args)
 
     if not spinner:
         chats = []
@@ -96,17 +139,235 @@ def create_chat(messages, temperature, functions, model, spinner=False, stream=T
     else:
         return spin(create_chat_model)
 
+class _Request:
+    """
+    A request for a chat, made on a daemon thread so that one that hangs
+    holds up neither the event loop's shutdown nor the program's exit. The
+    response is closed if the request is abandoned.
+    """
+    def __init__(self, loop, future):
+        self.loop = loop
+        self.future = future
+        self.lock = threading.Lock()
+        self.abandoned = False
+        self.response = None
+
+    def run(self, *args):
+        try:
+            response = create_chat(*args)
+        except Exception as e:
+            self.deliver(self.future.set_exception, e)
+            return
+        with self.lock:
+            abandoned = self.abandoned
+            if not abandoned:
+                self.response = response
+        if abandoned:
+            response.close()
+        else:
+            self.deliver(self.future.set_result, response)
+
+    def deliver(self, set_outcome, value):
+        def deliver_on_loop():
+            if not self.future.done():
+                set_outcome(value)
+        try:
+            self.loop.call_soon_threadsafe(deliver_on_loop)
+        except RuntimeError:
+            # The event loop has already closed.
+            pass
+
+    def abandon(self):
+        with self.lock:
+            self.abandoned = True
+            response = self.response
+        if response is not None:
+            response.close()
+
+async def create_chat_async(messages, temperature, functions, model):
+    """
+    Like create_chat, but waits for the response without blocking the
+    event loop. If this is cancelled first, the response is closed when it
+    arrives.
+    """
+    loop = asyncio.get_running_loop()
+    request = _Request(loop, loop.create_future())
+    threading.Thread(target=request.run, args=(messages, temperature, functions, model), daemon=True).start()
+    try:
+        return await request.future
+    except asyncio.CancelledError:
+        request.abandon()
+        raise
+
+# Marks the end of a stream in stream_chat's queue.
+_END_OF_STREAM = object()
+
+def _read_stream(chat, loop, queue, stop):
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # The event loop has already closed.
+            pass
+    try:
+        for resp in chat:
+            if stop.is_set():
+                break
+            put(resp)
+        put(_END_OF_STREAM)
+    except Exception as e:
+        put(e)
+    finally:
+        chat.close()
+
+async def stream_chat(chat, first_chunk_timeout=None, chunk_timeout=None):
+    """Yields the chunks of a streamed completion without blocking the event
+    loop. The stream is read on its own thread, which is the only one to
+    touch it, and it's closed when this generator is closed. Raises
+    asyncio.TimeoutError if a chunk takes longer than the given number of
+    seconds."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    threading.Thread(target=_read_stream, args=(chat, loop, queue, stop), daemon=True).start()
+    timeout = first_chunk_timeout
+    try:
+        while True:
+            item = await asyncio.wait_for(queue.get(), timeout)
+            timeout = chunk_timeout
+            if item is _END_OF_STREAM:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+# Deadlines in seconds for a streamed chat, on top of the HTTP session's
+# connect timeout: for the response to start, and for each gap between chunks.
+FIRST_TOKEN_TIMEOUT = 30
+CHUNK_TIMEOUT = 20
+# How many times a stalled request is retried, and the base of the
+# exponential backoff between attempts.
+STALL_RETRIES = 2
+RETRY_BACKOFF = 1.0
+
+class StallError(Exception):
+    pass
+
+@dataclass
+class StreamStats:
+    requests: int = 0
+    stalls: int = 0
+    retries: int = 0
+    # Seconds from sending each request to its first chunk.
+    ttfts: list = field(default_factory=list)
+
+class WatchedChat:
+    """
+    A streamed chat that is retried when it stalls. Call connect() and then
+    iterate over chunks().
+    """
+    def __init__(self, messages, temperature, functions, model, stats):
+        self.args = (messages, temperature, functions, model)
+        self.stats = stats
+        self.attempts = 0
+        self.started = None
+        self.first_chunk_received = False
+        self.stream = None
+        stats.requests += 1
+
+    async def connect(self, spinner=False):
+        """Sends the request, retrying if the response doesn't start in time.
+        Raises StallError once out of retries."""
+        while True:
+            if self.attempts:
+                self.stats.retries += 1
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (self.attempts - 1) * random.uniform(0.5, 1.5))
+            self.attempts += 1
+            if self.started is None:
+                self.started = time.monotonic()
+            try:
+                request = asyncio.wait_for(create_chat_async(*self.args), FIRST_TOKEN_TIMEOUT)
+                self.stream = await (spin_async(request) if spinner else request)
+                return
+            except (asyncio.TimeoutError, openai.error.Timeout, openai.error.APIConnectionError):
+                self.stats.stalls += 1
+                if self.attempts > STALL_RETRIES:
+                    raise StallError("the response never started")
+
+    async def chunks(self):
+        """
+        Yields chunks, reconnecting if the stream stalls. The text already
+        yielded is skipped in the retried stream so the caller sees one
+        continuous reply. If the retry doesn't reproduce it, or a tool
+        call was under way, StallError is raised instead.
+        """
+        yielded = ""
+        yielded_tool_call = False
+        while True:
+            received = ""
+            try:
+                async with aclosing(stream_chat(self.stream, FIRST_TOKEN_TIMEOUT, CHUNK_TIMEOUT)) as chunks:
+                    async for chunk in chunks:
+                        if not self.first_chunk_received:
+                            self.first_chunk_received = True
+                            self.stats.ttfts.append(time.monotonic() - self.started)
+                        choice = chunk.choices[0]
+                        if choice.delta.get("content"):
+                            received += choice.delta.content
+                            if not (received.startswith(yielded) or yielded.startswith(received)):
+                                raise StallError("the retried response differed from what was shown")
+                            if len(received) <= len(yielded):
+                                continue
+                            choice.delta.content = received[len(yielded):]
+                            yielded = received
+                        elif choice.finish_reason and len(received) < len(yielded):
+                            raise StallError("the retried response differed from what was shown")
+                        if choice.delta.get("tool_calls"):
+                            yielded_tool_call = True
+                        yield chunk
+                return
+            except asyncio.TimeoutError:
+                self.stats.stalls += 1
+                if yielded_tool_call or self.attempts > STALL_RETRIES:
+                    raise StallError("the response stalled")
+            await self.connect()
+
+def response_cache_key(model, messages, functions):
+    """Identifies a request by its model, messages and tool schemas."""
+    request = {"model": model, "messages": messages, "functions": tool_schemas(functions)}
+    return hashlib.sha256(simplejson.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+def replay_chat(chunks):
+    """A stream made from chunks recorded by record_chat."""
+    for chunk in chunks:
+        yield openai.openai_object.OpenAIObject.construct_from(chunk)
+
+async def record_chat(chunks, on_complete):
+    """Passes chunks through. When one with a finish reason arrives, calls
+    on_complete with all of them so far as dicts."""
+    recorded = []
+    try:
+        async for chunk in chunks:
+            recorded.append(chunk.to_dict_recursive())
+            if chunk.choices[0].finish_reason:
+                on_complete(recorded)
+            yield chunk
+    finally:
+        await chunks.aclose()
 
 def suggest_name(chat_id, message):
     try:
-        chat_completion_resp = openai.ChatCompletion.create(
+        chat_completion_resp = backend.chat_completion(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "You assign names to conversations based on the first message. Respond with only a short, descriptive title for a conversation."},
                 {"role": "user", "content": message}
             ],
             temperature=0,
-            max_tokens=10
+            max_tokens=10,
+            request_timeout=TIMEOUT
         )
         name = chat_completion_resp.choices[0].message.content
         return (chat_id, name)
@@ -114,22 +375,48 @@ def suggest_name(chat_id, message):
         return None
 
 def invoke(functions, name, args_str):
+    """Calls the tool called name, which must be one of the tuple of tool names in functions."""
+    t = find_tool(functions, name)
     try:
         args = simplejson.loads(args_str, strict=False)
     except Exception as e:
-        return invoke_sloppy(functions, name, args_str)
+        return invoke_sloppy(t, args_str)
+    return t.func(**args)
 
-    for func in functions:
-        if func.__name__ == name:
-            return func(**args)
-    else:
-        raise ValueError(f"Function '{name}' not found.")
+def invoke_sloppy(t, args_str):
+    if not t.sloppy:
+        raise ValueError(f"Invalid arguments for function '{t.func.__name__}'.")
+    args = [None] * t.num_params
+    args[0] = args_str
+    return t.func(*args)
 
-def invoke_sloppy(functions, name, args_str):
-    for func in functions:
-        if func.__name__ == name and func.sloppy:
-            args = [None] * len(inspect.signature(func).parameters)
-            args[0] = args_str
-            return func(*args)
-    else:
-        raise ValueError(f"Function '{name}' not found.")
+# Parallel tools run on this many threads at once.
+TOOL_WORKERS = 4
+tool_pool = concurrent.futures.ThreadPoolExecutor(TOOL_WORKERS)
+
+def _invoke_safely(functions, name, args_str):
+    try:
+        return (invoke(functions, name, args_str), None)
+    except Exception as e:
+        return (None, str(e))
+
+async def invoke_all(functions, calls, exclusive):
+    """
+    Runs [(name, arguments), ...] and returns [(output, error), ...] in the
+    same order. Parallel tools run concurrently on tool_pool. The rest may
+    prompt the user, so they run one at a time on this thread, each inside
+    the exclusive() context manager.
+    """
+    loop = asyncio.get_running_loop()
+    futures = {}
+    for (i, (name, args_str)) in enumerate(calls):
+        if name in TOOLS and TOOLS[name].parallel:
+            futures[i] = loop.run_in_executor(tool_pool, _invoke_safely, functions, name, args_str)
+    results = [None] * len(calls)
+    for (i, (name, args_str)) in enumerate(calls):
+        if i not in futures:
+            with exclusive():
+                results[i] = _invoke_safely(functions, name, args_str)
+    for (i, future) in futures.items():
+        results[i] = await future
+    return results
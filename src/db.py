@@ -1,9 +1,16 @@
 import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass
 from typing import Optional
 import fcntl
+import hashlib
+import itertools
 import json
 import os
 import sys
+import threading
+import time
+import zlib
 
 def fullpath(file):
     xdg_root = os.getenv("XDG_ROOT")
@@ -15,13 +22,456 @@ def fullpath(file):
 
 lock_fd = None
 
+# Message bodies at least this many bytes long are stored in the blobs table.
+# Function outputs like fetched web pages are often hundreds of KB and the
+# same one tends to be fetched again and again, so each distinct body is
+# stored once and shared by the messages that contain it. A blob is
+# zlib-compressed when that makes it smaller.
+COMPRESSION_THRESHOLD = 4096
+
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def is_large(content):
+    return content is not None and len(content.encode("utf-8")) >= COMPRESSION_THRESHOLD
+
+def encode_content(content):
+    if content is None:
+        return None
+    data = content.encode("utf-8")
+    if len(data) < COMPRESSION_THRESHOLD:
+        return content
+    compressed = zlib.compress(data)
+    if len(compressed) >= len(data):
+        return content
+    return compressed
+
+def decode_content(content):
+    if isinstance(content, bytes):
+        return zlib.decompress(content).decode("utf-8")
+    return content
+
+def chat_fulltext(role, content):
+    """Returns the text a message contributes to chat_fts."""
+    if content is None:
+        return ""
+    if role == "assistant":
+        return f"Assistant: {content}"
+    if role == "user":
+        return f"User: {content}"
+    return ""
+
+# Select MESSAGE_CONTENT from MESSAGES_WITH_BLOBS to get a message's content
+# wherever it is stored. Pass it through decode_content.
+MESSAGES_WITH_BLOBS = "messages LEFT JOIN blobs ON blobs.hash = messages.blob_hash"
+MESSAGE_CONTENT = "COALESCE(messages.content, blobs.content)"
+
+def migrate_add_messages_chat_index(conn):
+    # Serves every per-chat lookup of messages: counting, paging through a
+    # chat in order, and filtering search results to one chat.
+    conn.execute("CREATE INDEX IF NOT EXISTS messages_chat_id ON messages (chat_id, id)")
+
+def migrate_add_chat_summaries(conn):
+    """
+    chat_summaries holds the number of messages in each chat so listing
+    chats doesn't have to aggregate the messages table. Triggers keep it
+    current.
+    """
+    query = """
+    CREATE TABLE IF NOT EXISTS chat_summaries (
+        chat_id INTEGER PRIMARY KEY,
+        num_messages INTEGER NOT NULL DEFAULT 0
+    )
+    """
+    conn.execute(query)
+
+    query = """
+    CREATE TRIGGER IF NOT EXISTS chat_summaries_message_insert
+    AFTER INSERT ON messages
+    BEGIN
+        INSERT INTO chat_summaries (chat_id, num_messages) VALUES (NEW.chat_id, 1)
+        ON CONFLICT (chat_id) DO UPDATE SET num_messages = num_messages + 1;
+    END
+    """
+    conn.execute(query)
+
+    query = """
+    CREATE TRIGGER IF NOT EXISTS chat_summaries_message_delete
+    AFTER DELETE ON messages
+    BEGIN
+        UPDATE chat_summaries SET num_messages = num_messages - 1 WHERE chat_id = OLD.chat_id;
+    END
+    """
+    conn.execute(query)
+
+    query = """
+    CREATE TRIGGER IF NOT EXISTS chat_summaries_chat_delete
+    AFTER DELETE ON chats
+    BEGIN
+        DELETE FROM chat_summaries WHERE chat_id = OLD.id;
+    END
+    """
+    conn.execute(query)
+
+    # Populate it from messages that predate the table.
+    conn.execute("DELETE FROM chat_summaries")
+    query = """
+    INSERT INTO chat_summaries (chat_id, num_messages)
+    SELECT chat_id, COUNT(*) FROM messages GROUP BY chat_id
+    """
+    conn.execute(query)
+
+def rebuild_fts_table(conn, name, columns, options):
+    """FTS5 options can't be altered, so copy the rows into a new table."""
+    names = ", ".join(column.split(" ")[0] for column in columns)
+    conn.execute(f"CREATE VIRTUAL TABLE {name}_new USING FTS5 ({', '.join(columns)}, {options})")
+    conn.execute(f"INSERT INTO {name}_new (rowid, {names}) SELECT rowid, {names} FROM {name}")
+    conn.execute(f"DROP TABLE {name}")
+    conn.execute(f"ALTER TABLE {name}_new RENAME TO {name}")
+
+def migrate_add_fts_prefix_indexes(conn):
+    # Makes prefix queries like "ident*" as fast as whole-word queries. This
+    # also drops the unused content_rowid column from messages_fts.
+    rebuild_fts_table(conn, "messages_fts", ["message_id UNINDEXED", "content"], "prefix='2 3 4'")
+    rebuild_fts_table(conn, "chat_fts", ["chat_id UNINDEXED", "content"], "prefix='2 3 4'")
+
+def migrate_compress_messages(conn):
+    query = "SELECT id, content FROM messages WHERE typeof(content) = 'text' AND length(CAST(content AS BLOB)) >= ?"
+    rows = conn.execute(query, (COMPRESSION_THRESHOLD,))
+    query = "UPDATE messages SET content = ? WHERE id = ?"
+    conn.executemany(query, ((encode_content(content), message_id) for message_id, content in rows))
+
+def migrate_add_blobs(conn):
+    conn.execute("ALTER TABLE messages ADD COLUMN blob_hash TEXT NULL")
+
+    query = """
+    CREATE TABLE IF NOT EXISTS blobs (
+        hash TEXT PRIMARY KEY,
+        content BLOB NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0
+    )
+    """
+    conn.execute(query)
+
+    query = """
+    CREATE TRIGGER IF NOT EXISTS blobs_message_insert
+    AFTER INSERT ON messages
+    WHEN NEW.blob_hash IS NOT NULL
+    BEGIN
+        UPDATE blobs SET refcount = refcount + 1 WHERE hash = NEW.blob_hash;
+    END
+    """
+    conn.execute(query)
+
+    query = """
+    CREATE TRIGGER IF NOT EXISTS blobs_message_delete
+    AFTER DELETE ON messages
+    WHEN OLD.blob_hash IS NOT NULL
+    BEGIN
+        UPDATE blobs SET refcount = refcount - 1 WHERE hash = OLD.blob_hash;
+        DELETE FROM blobs WHERE hash = OLD.blob_hash AND refcount <= 0;
+    END
+    """
+    conn.execute(query)
+
+    # Move existing large bodies into blobs: those the previous migration
+    # compressed, and those it left as text because they didn't compress.
+    refcounts = {}
+    query = """
+    SELECT id, content FROM messages
+    WHERE typeof(content) = 'blob' OR (typeof(content) = 'text' AND length(CAST(content AS BLOB)) >= ?)
+    """
+    for message_id, content in conn.execute(query, (COMPRESSION_THRESHOLD,)).fetchall():
+        blob_hash = content_hash(decode_content(content))
+        if blob_hash not in refcounts:
+            conn.execute("INSERT OR IGNORE INTO blobs (hash, content) VALUES (?, ?)", (blob_hash, content))
+            refcounts[blob_hash] = 0
+        refcounts[blob_hash] += 1
+        conn.execute("UPDATE messages SET content = NULL, blob_hash = ? WHERE id = ?", (blob_hash, message_id))
+    query = "UPDATE blobs SET refcount = ? WHERE hash = ?"
+    conn.executemany(query, ((n, blob_hash) for blob_hash, n in refcounts.items()))
+
+def migrate_key_messages_fts_by_message_id(conn):
+    # Giving messages_fts rows the rowid of their message makes them cheap to
+    # find when the message is deleted. Rows of messages that were already
+    # deleted are left behind.
+    conn.execute("CREATE VIRTUAL TABLE messages_fts_new USING FTS5 (message_id UNINDEXED, content, prefix='2 3 4')")
+    query = """
+    INSERT OR REPLACE INTO messages_fts_new (rowid, message_id, content)
+    SELECT messages.id, messages.id, messages_fts.content
+    FROM messages_fts
+    JOIN messages ON messages.id = messages_fts.message_id
+    WHERE messages.deleted = 0
+    """
+    conn.execute(query)
+    conn.execute("DROP TABLE messages_fts")
+    conn.execute("ALTER TABLE messages_fts_new RENAME TO messages_fts")
+    conn.execute("DELETE FROM chat_fts WHERE rowid IN (SELECT id FROM messages WHERE deleted = 1)")
+
+    exists = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'messages_trigram'").fetchone()[0]
+    if exists:
+        conn.execute("DELETE FROM messages_trigram")
+        conn.execute("INSERT INTO messages_trigram (rowid, message_id, content) SELECT rowid, message_id, content FROM messages_fts")
+        conn.execute("DELETE FROM chat_trigram WHERE rowid IN (SELECT id FROM messages WHERE deleted = 1)")
+
+def migrate_add_chat_signatures(conn):
+    # Signatures used to find related chats. See related.py.
+    query = """
+    CREATE TABLE IF NOT EXISTS chat_signatures (
+        chat_id INTEGER PRIMARY KEY,
+        signature BLOB NOT NULL
+    )
+    """
+    conn.execute(query)
+
+    query = """
+    CREATE TRIGGER IF NOT EXISTS chat_signatures_chat_delete
+    AFTER DELETE ON chats
+    BEGIN
+        DELETE FROM chat_signatures WHERE chat_id = OLD.id;
+    END
+    """
+    conn.execute(query)
+
+def migrate_add_response_cache(conn):
+    # Recorded responses to deterministic requests, keyed by a hash of the
+    # request. See ChatDB.get_cached_response.
+    query = """
+    CREATE TABLE IF NOT EXISTS response_cache (
+        key TEXT PRIMARY KEY,
+        response,
+        size INTEGER NOT NULL,
+        created TEXT NOT NULL,
+        last_used TEXT NOT NULL
+    )
+    """
+    conn.execute(query)
+
+def migrate_add_tool_call_columns(conn):
+    # A tool message's call ID, and the calls an assistant message asked
+    # for as JSON.
+    conn.execute("ALTER TABLE messages ADD COLUMN tool_call_id TEXT NULL")
+    conn.execute("ALTER TABLE messages ADD COLUMN tool_calls TEXT NULL")
+
+# PRAGMA user_version holds the number of migrations that have been applied
+# to a database. Each runs once, in its own transaction. Only ever append to
+# this list.
+MIGRATIONS = [
+    migrate_add_messages_chat_index,
+    migrate_add_chat_summaries,
+    migrate_add_fts_prefix_indexes,
+    migrate_compress_messages,
+    migrate_add_blobs,
+    migrate_key_messages_fts_by_message_id,
+    migrate_add_chat_signatures,
+    migrate_add_response_cache,
+    migrate_add_tool_call_columns,
+]
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn, migrations=MIGRATIONS):
+    """Bring conn's schema up to date. Returns the resulting version."""
+    version = schema_version(conn)
+    for i in range(version, len(migrations)):
+        conn.execute("BEGIN")
+        try:
+            migrations[i](conn)
+            conn.execute(f"PRAGMA user_version = {i + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return schema_version(conn)
+
+# How many of the most recent times to first token are kept.
+TTFT_SAMPLES = 200
+
+# Cached responses expire after this many days.
+RESPONSE_CACHE_TTL_DAYS = 7
+# Least recently used responses are evicted once the cache is larger than this.
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+@dataclass
+class ChatSearchResult:
+    chat_id: int
+    name: str
+    # Matches are delimited by \ue000 and \ue001.
+    snippet: str
+
+@dataclass
+class MessageSearchResult:
+    message_id: int
+    role: str
+    time: str
+    deleted: int
+    snippet: str
+
+@dataclass
+class ChatMessagesSearchResult:
+    chat_id: int
+    name: str
+    messages: list
+
+# Pragmas applied to every connection. The "database-profile" setting picks
+# one of these and "database-pragmas" can override individual values.
+PERFORMANCE_PROFILES = {
+    "balanced": {
+        # In WAL mode NORMAL can only lose the last transactions on power loss.
+        "synchronous": "NORMAL",
+        "cache_size": -16384,  # KiB
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+        "wal_autocheckpoint": 1000,
+        # Truncate the WAL back to this size after a checkpoint.
+        "journal_size_limit": 67108864,
+    },
+    # For home directories on network filesystems, where mmap is unsafe.
+    "durable": {
+        "synchronous": "FULL",
+        "cache_size": -16384,
+        "mmap_size": 0,
+        "temp_store": "MEMORY",
+        "busy_timeout": 10000,
+        "wal_autocheckpoint": 1000,
+        "journal_size_limit": 67108864,
+    },
+    # SQLite's defaults, apart from bounding the WAL.
+    "minimal": {
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,
+        "wal_autocheckpoint": 1000,
+        "journal_size_limit": 67108864,
+    },
+}
+DEFAULT_PROFILE = "balanced"
+
+# Columns copied when moving chats between databases.
+MESSAGE_COLUMNS = "id, chat_id, role, content, time, deleted, function_call_name, function_call_arguments, blob_hash, tool_call_id, tool_calls"
+
 class ChatDB:
-    def __init__(self, db_file=".chatgpt.db"):
-        db_path = fullpath(db_file)
-        self.conn = sqlite3.connect(db_path)
+    def __init__(self, db_file=".chatgpt.db", archive_file=".chatgpt-archive.db"):
+        self.db_path = fullpath(db_file)
+        self.archive_path = fullpath(archive_file) if archive_file else None
+        self.archive_db = None
+        self.pragmas = PERFORMANCE_PROFILES[DEFAULT_PROFILE]
+        self.local = threading.local()
+        # SQLite allows one writer at a time. Writers in this process take
+        # turns on this lock instead of failing with "database is locked".
+        self.write_lock = threading.RLock()
+        # Only takes effect for a new file. Existing databases are converted
+        # by gptline compact or gptline maintain; see reclaim_space.
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
         self.conn.execute("PRAGMA journal_mode=WAL")  # Enable WAL mode
-        self.cursor = self.conn.cursor()
+        # Migrations can rewrite the whole database, so they run with the
+        # chosen profile.
+        self.load_performance_profile()
         self.create_schema()
+        self.substring_search = self.table_exists("messages_trigram")
+
+    @property
+    def conn(self):
+        """
+        Each thread gets its own connection, so background tasks can use the
+        database directly. In WAL mode they read concurrently with the
+        writer.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path)
+            self.apply_pragmas(conn)
+            self.local.conn = conn
+            self.local.cursor = conn.cursor()
+            self.local.transaction_depth = 0
+        return conn
+
+    def load_performance_profile(self):
+        """
+        Reads the pragmas to use from settings and applies them to this
+        thread's connection. Connections opened later get them too. A new
+        database, which has no settings table yet, gets the default.
+        """
+        if self.table_exists("settings"):
+            name = self.get_setting("database-profile", DEFAULT_PROFILE)
+            overrides = self.get_setting("database-pragmas", {})
+        else:
+            name = DEFAULT_PROFILE
+            overrides = {}
+        pragmas = dict(PERFORMANCE_PROFILES.get(name, PERFORMANCE_PROFILES[DEFAULT_PROFILE]))
+        for key, value in overrides.items():
+            if key in pragmas and str(value).lstrip("-").isalnum():
+                pragmas[key] = value
+        self.pragmas = pragmas
+        self.apply_pragmas(self.conn)
+
+    def apply_pragmas(self, conn):
+        for key, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {key}={value}")
+
+    @property
+    def cursor(self):
+        self.conn  # Make sure this thread's connection exists.
+        return self.local.cursor
+
+    @contextmanager
+    def transaction(self):
+        """
+        Writes made inside the block are committed together when the
+        outermost transaction exits, or all rolled back if it raises. Only
+        one thread may be inside a transaction at a time, so don't wait on
+        the network or the user inside one; see write_behind.
+        """
+        conn = self.conn
+        with self.write_lock:
+            # sqlite3 only begins a transaction implicitly before DML, so
+            # DDL like CREATE TABLE would otherwise commit on its own.
+            if self.local.transaction_depth == 0 and not conn.in_transaction:
+                conn.execute("BEGIN")
+            self.local.transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.local.transaction_depth -= 1
+                if self.local.transaction_depth == 0:
+                    conn.rollback()
+                raise
+            self.local.transaction_depth -= 1
+            if self.local.transaction_depth == 0:
+                conn.commit()
+
+    @contextmanager
+    def write_behind(self):
+        """
+        Writes passed to defer() inside the block are queued and then made in
+        one transaction when it exits, or dropped if it raises. A
+        conversation turn runs inside one so that it's a single, atomic
+        commit without holding the write lock while the reply streams in or
+        a tool waits for confirmation.
+        """
+        self.conn  # Make sure this thread's connection exists.
+        self.local.deferred = []
+        try:
+            yield self
+        except BaseException:
+            self.local.deferred = None
+            raise
+        (deferred, self.local.deferred) = (self.local.deferred, None)
+        with self.transaction():
+            for write in deferred:
+                write()
+
+    def defer(self, write):
+        """Calls write() when this thread's write_behind block exits, or right away outside of one."""
+        deferred = getattr(self.local, "deferred", None)
+        if deferred is None:
+            write()
+        else:
+            deferred.append(write)
 
     def create_schema(self):
         query = """
@@ -81,69 +531,251 @@ class ChatDB:
         """
         self.conn.execute(query)
 
+        migrate(self.conn)
+
+    def table_exists(self, name):
+        query = "SELECT COUNT(*) FROM sqlite_master WHERE name = ?"
+        return self.conn.execute(query, (name,)).fetchone()[0] > 0
+
+    def set_substring_search(self, enabled: bool):
+        """
+        Substring search uses trigram indexes that mirror messages_fts and
+        chat_fts. They are several times larger than the word indexes, so
+        they only exist while substring search is enabled. Raises
+        sqlite3.OperationalError if SQLite lacks the trigram tokenizer.
+        """
+        if enabled == self.substring_search:
+            return
+        with self.transaction():
+            if enabled:
+                query = """
+                CREATE VIRTUAL TABLE messages_trigram USING FTS5 (
+                    message_id UNINDEXED,
+                    content,
+                    tokenize='trigram'
+                )
+                """
+                self.conn.execute(query)
+                query = """
+                CREATE VIRTUAL TABLE chat_trigram USING FTS5 (
+                    chat_id UNINDEXED,
+                    content,
+                    tokenize='trigram'
+                )
+                """
+                self.conn.execute(query)
+                query = "INSERT INTO messages_trigram (rowid, message_id, content) SELECT rowid, message_id, content FROM messages_fts"
+                self.conn.execute(query)
+                query = "INSERT INTO chat_trigram (rowid, chat_id, content) SELECT rowid, chat_id, content FROM chat_fts"
+                self.conn.execute(query)
+            else:
+                self.conn.execute("DROP TABLE messages_trigram")
+                self.conn.execute("DROP TABLE chat_trigram")
+        self.substring_search = enabled
+
     def create_chat(self, name=None):
         query = "INSERT INTO chats (name) VALUES (?)"
-        self.cursor.execute(query, (name,))
-        chat_id = self.cursor.lastrowid  # Access lastrowid from the cursor
-        self.conn.commit()
+        with self.transaction():
+            self.cursor.execute(query, (name,))
+            chat_id = self.cursor.lastrowid  # Access lastrowid from the cursor
+            if name is not None:
+                self.set_chat_fulltext_name(chat_id, name)
         return chat_id
 
-    def add_message(self, chat_id: int, role: str, content: str, function_call_name: Optional[str], function_call_arguments: Optional[str]):
-        query = "INSERT INTO messages (chat_id, role, content, function_call_name, function_call_arguments) VALUES (?, ?, ?, ?, ?)"
-        with self.conn:
-            self.cursor.execute(query, (chat_id, role, content, function_call_name, function_call_arguments))
-            last_message_id = self.cursor.lastrowid
+    def insert_message(self, chat_id: int, role: str, content: str, function_call_name: Optional[str], function_call_arguments: Optional[str], time=None, deleted=0, tool_call_id: Optional[str] = None, tool_calls: Optional[str] = None):
+        """Inserts a row into messages without indexing it. Returns its ID."""
+        query = """
+        INSERT INTO messages (chat_id, role, content, function_call_name, function_call_arguments, blob_hash, time, deleted, tool_call_id, tool_calls)
+        VALUES (?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?)
+        """
+        with self.transaction():
+            if is_large(content):
+                blob_hash = content_hash(content)
+                # Only compress a body that isn't stored yet.
+                if self.conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (blob_hash,)).fetchone() is None:
+                    blob_query = "INSERT INTO blobs (hash, content) VALUES (?, ?)"
+                    self.cursor.execute(blob_query, (blob_hash, encode_content(content)))
+                encoded = None
+            else:
+                blob_hash = None
+                encoded = content
+            self.cursor.execute(query, (chat_id, role, encoded, function_call_name, function_call_arguments, blob_hash, time, deleted, tool_call_id, tool_calls))
+            return self.cursor.lastrowid
 
-            if content is not None and role != "function":
-                fts_query = "INSERT INTO messages_fts (message_id, content) VALUES (?, ?)"
-                self.conn.execute(fts_query, (last_message_id, content.lower()))
+    def add_message(self, chat_id: int, role: str, content: str, function_call_name: Optional[str], function_call_arguments: Optional[str], tool_call_id: Optional[str] = None, tool_calls: Optional[str] = None):
+        with self.transaction():
+            last_message_id = self.insert_message(chat_id, role, content, function_call_name, function_call_arguments,
+                                                  tool_call_id=tool_call_id, tool_calls=tool_calls)
+
+            if content is not None and role not in ("function", "tool"):
+                for table in self.messages_fts_tables():
+                    fts_query = f"INSERT INTO {table} (rowid, message_id, content) VALUES (?, ?, ?)"
+                    self.cursor.execute(fts_query, (last_message_id, last_message_id, content.lower()))
 
             query = f"UPDATE chats SET last_update = CURRENT_TIMESTAMP WHERE id = ?"
             self.cursor.execute(query, (chat_id, ))
 
         return last_message_id
 
-    def set_chat_fulltext(self, chat_id, content):
-        # Remove existing chat_fts row with chat_id
-        delete_query = "DELETE FROM chat_fts WHERE chat_id = ?"
-        self.cursor.execute(delete_query, (chat_id,))
-
-        # Insert new chat_fts row with chat_id and content
-        insert_query = "INSERT INTO chat_fts (chat_id, content) VALUES (?, ?)"
-        self.cursor.execute(insert_query, (chat_id, content))
+    def set_chat_fulltext_name(self, chat_id: int, name: str):
+        """
+        chat_fts holds one row per indexed message, whose rowid is the
+        message's id, plus one row for the chat's name at rowid -chat_id.
+        Replace the name row.
+        """
+        with self.transaction():
+            for table in self.chat_fts_tables():
+                self.cursor.execute(f"DELETE FROM {table} WHERE rowid = ?", (-chat_id,))
+                insert_query = f"INSERT INTO {table} (rowid, chat_id, content) VALUES (?, ?, ?)"
+                self.cursor.execute(insert_query, (-chat_id, chat_id, name))
 
-        # Commit the changes
-        self.conn.commit()
+    def add_chat_fulltext(self, chat_id: int, message_id: int, content: str):
+        """Append one message's text to the chat-level index."""
+        with self.transaction():
+            for table in self.chat_fts_tables():
+                insert_query = f"INSERT OR REPLACE INTO {table} (rowid, chat_id, content) VALUES (?, ?, ?)"
+                self.cursor.execute(insert_query, (message_id, chat_id, content))
 
+    def clear_chat_fulltext(self):
+        with self.transaction():
+            for table in self.chat_fts_tables():
+                self.cursor.execute(f"DELETE FROM {table}")
 
-    def num_messages(self, chat_id: int) -> int:
-        query = "SELECT COUNT(*) FROM messages WHERE chat_id = ?"
+    def get_chat_signature(self, chat_id: int):
+        query = "SELECT signature FROM chat_signatures WHERE chat_id = ?"
         result = self.conn.execute(query, (chat_id,)).fetchone()
-        return result[0]
+        return result[0] if result else None
 
-    def get_message_by_id(self, message_id: int):
-        query = "SELECT role, content, time, id, deleted FROM messages WHERE id = ?"
-        result = self.conn.execute(query, (message_id,)).fetchone()
-        if result:
-            return result
-        else:
-            raise IndexError("Index out of range")
+    def set_chat_signature(self, chat_id: int, signature: bytes):
+        query = "INSERT OR REPLACE INTO chat_signatures (chat_id, signature) VALUES (?, ?)"
+        with self.transaction():
+            self.conn.execute(query, (chat_id, signature))
 
-    def get_message_by_index(self, chat_id: int, index: int):
-        query = "SELECT role, content, time, id, deleted, function_call_name, function_call_arguments FROM messages WHERE chat_id = ? ORDER BY id LIMIT 1 OFFSET ?"
-        result = self.conn.execute(query, (chat_id, index)).fetchone()
-        if result:
-            return result
-        else:
-            raise IndexError("Index out of range")
+    def get_chat_signatures(self):
+        """Yields (chat ID, signature) for every chat that has one."""
+        cursor = self.conn.execute("SELECT chat_id, signature FROM chat_signatures ORDER BY chat_id")
+        for row in cursor:
+            yield row
+
+    def get_unsigned_chat_fulltext(self, after_chat_id: int, limit: int):
+        """
+        Returns ([chat ID, ...], [(chat ID, text), ...]) for up to limit
+        chats without a signature whose IDs are greater than after_chat_id,
+        in order, and their rows in chat_fts. Everything is fetched before
+        returning so the caller can write between batches.
+        """
+        query = "SELECT id FROM chats WHERE id > ? AND id NOT IN (SELECT chat_id FROM chat_signatures) ORDER BY id LIMIT ?"
+        chat_ids = [row[0] for row in self.conn.execute(query, (after_chat_id, limit))]
+        if not chat_ids:
+            return ([], [])
+        # Rows are found by rowid: their message's ID, or -chat_id for the name.
+        ids = json.dumps(chat_ids)
+        query = """
+        SELECT chat_id, content FROM chat_fts
+        WHERE rowid IN (
+            SELECT id FROM messages WHERE chat_id IN (SELECT value FROM json_each(?))
+            UNION ALL
+            SELECT -value FROM json_each(?))
+        ORDER BY chat_id
+        """
+        return (chat_ids, self.conn.execute(query, (ids, ids)).fetchall())
+
+    def needs_chat_reindex(self):
+        return self.get_kv("chat_fts_migration") != "incremental"
+
+    def reindex_chats(self, batch_size: int = 200, restart: bool = False):
+        """
+        Rebuilds chat_fts from chats and messages. Each batch of chats is
+        committed along with how far the rebuild got, so an interrupted
+        rebuild resumes where it stopped unless restart is True.
+        Yields (chats done, total chats, messages indexed, seconds elapsed)
+        after each batch.
+        """
+        with self.transaction():
+            last_chat_id = self.get_kv("chat_fts_reindex_progress")
+            if restart or last_chat_id is None:
+                self.clear_chat_fulltext()
+                last_chat_id = 0
+                self.set_kv("chat_fts_reindex_progress", last_chat_id)
+
+        total = self.conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+        done = self.conn.execute("SELECT COUNT(*) FROM chats WHERE id <= ?", (last_chat_id,)).fetchone()[0]
+        num_messages = 0
+        start = time.time()
+        message_query = f"""
+        SELECT messages.id, chat_id, role, {MESSAGE_CONTENT}
+        FROM {MESSAGES_WITH_BLOBS}
+        WHERE chat_id BETWEEN ? AND ? AND deleted = 0 AND role IN ('user', 'assistant')
+        """
+        while True:
+            query = "SELECT id, name FROM chats WHERE id > ? ORDER BY id LIMIT ?"
+            chats = self.conn.execute(query, (last_chat_id, batch_size)).fetchall()
+            if not chats:
+                break
+            first_chat_id = chats[0][0]
+            last_chat_id = chats[-1][0]
+            # Inserts replace, in case messages were indexed as they were
+            # added while a previous rebuild was incomplete.
+            insert_queries = [f"INSERT OR REPLACE INTO {table} (rowid, chat_id, content) VALUES (?, ?, ?)"
+                              for table in self.chat_fts_tables()]
+            with self.transaction():
+                for insert_query in insert_queries:
+                    self.cursor.executemany(insert_query, ((-chat_id, chat_id, name) for (chat_id, name) in chats if name is not None))
+                for (message_id, chat_id, role, content) in self.conn.execute(message_query, (first_chat_id, last_chat_id)):
+                    text = chat_fulltext(role, decode_content(content))
+                    if text:
+                        for insert_query in insert_queries:
+                            self.cursor.execute(insert_query, (message_id, chat_id, text))
+                        num_messages += 1
+                self.set_kv("chat_fts_reindex_progress", last_chat_id)
+            done += len(chats)
+            yield (done, total, num_messages, time.time() - start)
+
+        with self.transaction():
+            self.set_kv("chat_fts_migration", "incremental")
+            self.set_kv("chat_fts_reindex_progress", None)
+
+    def messages_fts_tables(self):
+        """messages_fts has one row per searchable message, whose rowid is the message's id."""
+        if self.substring_search:
+            return ["messages_fts", "messages_trigram"]
+        return ["messages_fts"]
+
+    def chat_fts_tables(self):
+        if self.substring_search:
+            return ["chat_fts", "chat_trigram"]
+        return ["chat_fts"]
+
+    def get_messages(self, chat_id: int, after_id: Optional[int] = None, before_id: Optional[int] = None, limit: Optional[int] = None):
+        """
+        Yields (role, content, time, id, deleted, function_call_name,
+        function_call_arguments, tool_call_id, tool_calls) for the messages
+        of chat_id in id order from
+        a single cursor. after_id and before_id bound the window exclusively so
+        a caller can page through a long chat by passing the last id it saw.
+        """
+        query = f"SELECT role, {MESSAGE_CONTENT}, time, id, deleted, function_call_name, function_call_arguments, tool_call_id, tool_calls FROM {MESSAGES_WITH_BLOBS} WHERE chat_id = ?"
+        parameters = [chat_id]
+        if after_id is not None:
+            query += " AND id > ?"
+            parameters.append(after_id)
+        if before_id is not None:
+            query += " AND id < ?"
+            parameters.append(before_id)
+        query += " ORDER BY id"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+        cursor = self.conn.execute(query, parameters)
+        for (role, content, *rest) in cursor:
+            yield (role, decode_content(content), *rest)
 
     def list_chats(self):
       query = """
-      SELECT chats.id, chats.name, chats.last_update, COUNT(messages.id) as num_messages
+      SELECT chats.id, chats.name, chats.last_update, chat_summaries.num_messages
       FROM chats
-      LEFT JOIN messages ON chats.id = messages.chat_id
-      GROUP BY chats.id
-      HAVING COUNT(messages.id) > 1
+      JOIN chat_summaries ON chats.id = chat_summaries.chat_id
+      WHERE chat_summaries.num_messages > 1
       ORDER BY chats.id DESC
       """
       result = self.conn.execute(query).fetchall()
@@ -151,8 +783,9 @@ class ChatDB:
 
     def set_chat_name(self, chat_id: int, name: str):
         query = "UPDATE chats SET name = ? WHERE id = ?"
-        self.conn.execute(query, (name, chat_id))
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(query, (name, chat_id))
+            self.set_chat_fulltext_name(chat_id, name)
 
     def get_chat_name(self, chat_id):
         query = "SELECT name FROM chats WHERE id = ?"
@@ -163,101 +796,564 @@ class ChatDB:
         else:
             return None
 
+    def get_chat_names(self, chat_ids):
+        """Returns {chat ID: name} for those of chat_ids that exist."""
+        query = "SELECT id, name FROM chats WHERE id IN (SELECT value FROM json_each(?))"
+        return dict(self.conn.execute(query, (json.dumps(chat_ids),)).fetchall())
+
     def delete_message(self, message_id: int):
         query = """
         UPDATE messages
         SET deleted = 1
         WHERE id = ?
         """
-        self.conn.execute(query, (message_id,))
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(query, (message_id,))
+            # Deleted messages are no longer searchable.
+            for table in self.messages_fts_tables() + self.chat_fts_tables():
+                self.conn.execute(f"DELETE FROM {table} WHERE rowid = ?", (message_id,))
 
-    def tokenize_fts(self, query):
-        words = query.split(" ")
-        escaped_words = [word.replace('"', '""') for word in words]
-        quoted_words = [f'"{w}"' for w in escaped_words]
-        return " ".join(quoted_words)
+    def compact(self, min_age_days: int = 30):
+        """
+        Permanently removes deleted messages that were written at least
+        min_age_days ago, merges the full text index segments and returns
+        freed space to the filesystem. Returns the number of messages removed.
+        """
+        query = "DELETE FROM messages WHERE deleted = 1 AND time < datetime('now', ?)"
+        with self.transaction():
+            n = self.conn.execute(query, (f"-{min_age_days} days",)).rowcount
+            self.optimize_fts()
+        self.reclaim_space(full=True)
+        return n
 
-    def search_chats(self, query: str, pagination_token: int, limit: int):
+    def optimize_fts(self):
+        """Merges each full text index into a single segment."""
+        with self.transaction():
+            for table in self.messages_fts_tables() + self.chat_fts_tables():
+                self.conn.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+
+    def check_integrity(self):
+        """Returns "ok" or a description of the problems found."""
+        problems = [row[0] for row in self.conn.execute("PRAGMA integrity_check")]
+        for table in self.messages_fts_tables() + self.chat_fts_tables():
+            try:
+                with self.transaction():
+                    self.conn.execute(f"INSERT INTO {table} ({table}) VALUES ('integrity-check')")
+            except sqlite3.DatabaseError as e:
+                problems.append(f"{table}: {e}")
+        problems = [problem for problem in problems if problem != "ok"]
+        return "; ".join(problems) if problems else "ok"
+
+    def checkpoint(self):
+        """Copies the WAL into the database and truncates it."""
+        with self.write_lock:
+            busy, log_pages, checkpointed_pages = self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        if busy:
+            return f"incomplete, a reader is active ({checkpointed_pages} of {log_pages} pages)"
+        return f"{checkpointed_pages} pages"
+
+    def maintain(self):
         """
-        Searches chats across the contents of messages.
-        Returns ([(chat ID, snippet), ...], next pagination token)
+        Runs every maintenance step. Yields (step name, seconds taken,
+        result) as each one finishes.
         """
+        def analyze():
+            with self.write_lock:
+                self.conn.execute("ANALYZE")
+            return "done"
 
-        query = self.tokenize_fts(query)
-        fts_query = """
-            SELECT chat_id, snippet(chat_fts, 1, '\ue000', '\ue001', '...', 16) AS snippet
-            FROM chat_fts
-            WHERE content MATCH ?
-            LIMIT ?
-            OFFSET ?
+        def optimize():
+            self.optimize_fts()
+            return "done"
+
+        steps = [
+            ("analyze", analyze),
+            ("merge full text indexes", optimize),
+            ("reclaim free space", lambda: self.reclaim_space(full=True)),
+            ("checkpoint", self.checkpoint),
+            ("integrity check", self.check_integrity),
+        ]
+        for (name, step) in steps:
+            start = time.time()
+            result = step()
+            yield (name, time.time() - start, result)
+
+    def get_cached_response(self, key: str):
+        """
+        Returns the list of chunks recorded for a request, or None. The hit
+        or miss is counted along with the turn's other writes; see defer.
+        """
+        query = f"""
+        SELECT response FROM response_cache
+        WHERE key = ? AND created >= datetime('now', '-{RESPONSE_CACHE_TTL_DAYS} days')
+        """
+        result = self.conn.execute(query, (key,)).fetchone()
+        self.defer(lambda: self.count_cache_lookup(key, result is not None))
+        return json.loads(decode_content(result[0])) if result else None
+
+    def count_cache_lookup(self, key: str, hit: bool):
+        with self.transaction():
+            if hit:
+                self.conn.execute("UPDATE response_cache SET last_used = datetime('now') WHERE key = ?", (key,))
+            counter = "response_cache_hits" if hit else "response_cache_misses"
+            self.set_kv(counter, self.get_kv(counter, 0) + 1)
+
+    def set_cached_response(self, key: str, chunks):
+        response = encode_content(json.dumps(chunks))
+        size = len(response) if isinstance(response, bytes) else len(response.encode("utf-8"))
+        query = """
+        INSERT OR REPLACE INTO response_cache (key, response, size, created, last_used)
+        VALUES (?, ?, ?, datetime('now'), datetime('now'))
+        """
+        with self.transaction():
+            self.conn.execute(query, (key, response, size))
+            self.evict_cached_responses()
+
+    def evict_cached_responses(self):
+        """Removes expired responses and then the least recently used ones over the size limit."""
+        with self.transaction():
+            self.conn.execute(f"DELETE FROM response_cache WHERE created < datetime('now', '-{RESPONSE_CACHE_TTL_DAYS} days')")
+            query = """
+            DELETE FROM response_cache WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY last_used DESC, rowid DESC) AS total
+                    FROM response_cache
+                )
+                WHERE total > ?
+            )
             """
-        if pagination_token is None:
-            offset = 0
-        else:
-            offset = pagination_token
-        parameters = (query.lower(), limit, offset)
-        print(fts_query)
-        print(query)
+            self.conn.execute(query, (RESPONSE_CACHE_MAX_BYTES,))
 
-        results = list(self.conn.execute(fts_query, parameters))
-        return results, (offset + len(results))
+    def response_cache_stats(self):
+        """Returns (number of responses, total bytes, hits, misses)."""
+        (count, size) = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache").fetchone()
+        return (count, size, self.get_kv("response_cache_hits", 0), self.get_kv("response_cache_misses", 0))
 
+    def clear_response_cache(self):
+        with self.transaction():
+            self.conn.execute("DELETE FROM response_cache")
+            self.set_kv("response_cache_hits", 0)
+            self.set_kv("response_cache_misses", 0)
 
-    def search_messages_in_chat(self, query: str, chat_id: int):
-        query = self.tokenize_fts(query)
-        fts_query = """
-            SELECT m.id
-            FROM messages_fts
-            JOIN messages m ON messages_fts.message_id = m.id
-            WHERE messages_fts.content MATCH ? AND m.chat_id=?
-            ORDER BY m.id ASC
+    def get_stream_stats(self):
+        """Returns a dict of request, stall and retry counts, and recent times to first token."""
+        return self.get_kv("stream_stats", {"requests": 0, "stalls": 0, "retries": 0, "ttfts": []})
+
+    def record_stream_stats(self, stats):
+        """Adds a StreamStats to the running totals."""
+        if not stats.requests:
+            return
+        with self.transaction():
+            totals = self.get_stream_stats()
+            totals["requests"] += stats.requests
+            totals["stalls"] += stats.stalls
+            totals["retries"] += stats.retries
+            totals["ttfts"] = (totals["ttfts"] + [round(t, 3) for t in stats.ttfts])[-TTFT_SAMPLES:]
+            self.set_kv("stream_stats", totals)
+
+    def get_chats(self):
+        """Yields (id, name, last_update) for every chat, oldest first."""
+        cursor = self.conn.execute("SELECT id, name, last_update FROM chats ORDER BY id")
+        for row in cursor:
+            yield row
+
+    def export_records(self):
+        """
+        Yields a dict for each chat followed by one for each of its
+        messages. Archived chats come after the rest; they keep their IDs, so
+        those are still unique. Only one chat is held in memory at a time.
         """
+        chat_dbs = [self]
+        if self.archive():
+            chat_dbs.append(self.archive())
+        for chat_db in chat_dbs:
+            yield from chat_db.export_own_records()
 
-        parameters = (query.lower(), chat_id)
-        return [row[0] for row in self.conn.execute(fts_query, parameters)]
+    def export_own_records(self):
+        """Like export_records, without the archive."""
+        for (chat_id, name, last_update) in self.get_chats():
+            yield {"type": "chat", "id": chat_id, "name": name, "last_update": last_update}
+            for (role, content, time, message_id, deleted, fname, fargs, tool_call_id, tool_calls) in self.get_messages(chat_id):
+                yield {
+                    "type": "message",
+                    "chat_id": chat_id,
+                    "role": role,
+                    "content": content,
+                    "time": time,
+                    "deleted": deleted,
+                    "function_call_name": fname,
+                    "function_call_arguments": fargs,
+                    "tool_call_id": tool_call_id,
+                    "tool_calls": tool_calls,
+                }
 
-    def search_messages(self, query: str, pagination_token: int, limit: int):
-        query = self.tokenize_fts(query)
-        fts_query = """
-            SELECT m.id, m.chat_id, snippet(messages_fts, 1, '\ue000', '\ue001', '...', 16) AS snippet
-            FROM messages_fts
-            JOIN messages m ON messages_fts.message_id = m.id
-            WHERE messages_fts.content MATCH ?
-            LIMIT ?
-            OFFSET ?
+    def import_records(self, records, batch_size=1000):
+        """
+        Adds chats from records like those yielded by export_records. Chats
+        and messages get new IDs. Rows are committed batch_size at a time,
+        each batch along with its full text index rows, so an import that
+        fails partway leaves everything it did add searchable.
+        Returns (number of chats, number of messages).
         """
+        chat_ids = {}
+        num_messages = 0
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            first_chat_id = None
+            first_message_id = None
+            with self.transaction():
+                for record in batch:
+                    if record["type"] == "chat":
+                        query = "INSERT INTO chats (name, last_update) VALUES (?, COALESCE(?, CURRENT_TIMESTAMP))"
+                        self.cursor.execute(query, (record.get("name"), record.get("last_update")))
+                        chat_ids[record["id"]] = self.cursor.lastrowid
+                        if first_chat_id is None:
+                            first_chat_id = self.cursor.lastrowid
+                    elif record["type"] == "message":
+                        message_id = self.insert_message(
+                                chat_ids[record["chat_id"]],
+                                record["role"],
+                                record.get("content"),
+                                record.get("function_call_name"),
+                                record.get("function_call_arguments"),
+                                record.get("time"),
+                                record.get("deleted", 0),
+                                record.get("tool_call_id"),
+                                record.get("tool_calls"))
+                        if first_message_id is None:
+                            first_message_id = message_id
+                        num_messages += 1
+                    else:
+                        raise ValueError(f"Unknown record type {record['type']}")
+                self.index_imported(first_chat_id, first_message_id)
+        return (len(chat_ids), num_messages)
 
+    def index_imported(self, first_chat_id, first_message_id):
+        """
+        Indexes the names of chats with IDs at least first_chat_id and
+        messages with IDs at least first_message_id. Either may be None.
+        """
+        with self.transaction():
+            if first_chat_id is not None:
+                for table in self.chat_fts_tables():
+                    query = f"INSERT INTO {table} (rowid, chat_id, content) SELECT -id, id, name FROM chats WHERE id >= ? AND name IS NOT NULL"
+                    self.conn.execute(query, (first_chat_id,))
+            if first_message_id is not None:
+                query = f"""
+                SELECT id, chat_id, role, {MESSAGE_CONTENT} FROM {MESSAGES_WITH_BLOBS}
+                WHERE messages.id >= ? AND deleted = 0 AND role NOT IN ('function', 'tool') AND {MESSAGE_CONTENT} IS NOT NULL
+                """
+                rows = ((message_id, chat_id, role, decode_content(content))
+                        for (message_id, chat_id, role, content) in self.conn.execute(query, (first_message_id,)).fetchall())
+                for (message_id, chat_id, role, content) in rows:
+                    for table in self.messages_fts_tables():
+                        self.cursor.execute(f"INSERT INTO {table} (rowid, message_id, content) VALUES (?, ?, ?)", (message_id, message_id, content.lower()))
+                    text = chat_fulltext(role, content)
+                    if text:
+                        for table in self.chat_fts_tables():
+                            self.cursor.execute(f"INSERT INTO {table} (rowid, chat_id, content) VALUES (?, ?, ?)", (message_id, chat_id, text))
+
+    def archive(self, create=False):
+        """
+        Returns a ChatDB for the archive of old chats, or None if there is no
+        archive and create is False. Archived chats keep their IDs, so search
+        results from the archive can be restored with restore_chat.
+        """
+        if self.archive_db is None and self.archive_path:
+            if create or os.path.exists(self.archive_path):
+                self.archive_db = ChatDB(self.archive_path, None)
+        return self.archive_db
+
+    @contextmanager
+    def attached_archive(self):
+        self.archive(create=True)
+        with self.write_lock:
+            self.conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+            try:
+                yield
+            finally:
+                self.conn.execute("DETACH DATABASE archive")
+
+    def archive_chats(self, max_age_days: int):
+        """
+        Moves chats that haven't been updated in max_age_days into the
+        archive, deletes chats that never got past the system message, and
+        returns the freed space to the filesystem if that's quick; see
+        reclaim_space. Returns the number of chats archived.
+        """
+        age = f"-{max_age_days} days"
+        query = """
+        SELECT chats.id FROM chats
+        LEFT JOIN chat_summaries ON chat_summaries.chat_id = chats.id
+        WHERE COALESCE(chat_summaries.num_messages, 0) <= 1 AND chats.last_update < datetime('now', '-1 day')
+        """
+        empty_chat_ids = [row[0] for row in self.conn.execute(query)]
+        query = """
+        SELECT chats.id FROM chats
+        JOIN chat_summaries ON chat_summaries.chat_id = chats.id
+        WHERE chat_summaries.num_messages > 1 AND chats.last_update < datetime('now', ?)
+        """
+        chat_ids = [row[0] for row in self.conn.execute(query, (age,))]
+        if not chat_ids and not empty_chat_ids:
+            return 0
+
+        with self.attached_archive():
+            with self.transaction():
+                self.copy_chats(chat_ids, "main", "archive")
+                self.remove_chats(chat_ids + empty_chat_ids, "main")
+        self.reclaim_space()
+        return len(chat_ids)
+
+    def restore_chat(self, chat_id: int):
+        """Moves an archived chat back into this database."""
+        with self.attached_archive():
+            with self.transaction():
+                self.copy_chats([chat_id], "archive", "main")
+                self.remove_chats([chat_id], "archive")
+
+    def copy_chats(self, chat_ids, source, destination):
+        """
+        Copies chats with their messages, blobs and index rows between main
+        and the attached archive.
+        """
+        ids = json.dumps(chat_ids)
+        in_chats = "IN (SELECT value FROM json_each(?))"
+        in_messages = f"IN (SELECT id FROM {source}.messages WHERE chat_id {in_chats})"
+        queries = [
+            f"""INSERT INTO {destination}.chats (id, name, last_update)
+                SELECT id, name, last_update FROM {source}.chats WHERE id {in_chats}""",
+            # blobs must exist before the messages whose triggers count references to them.
+            f"""INSERT OR IGNORE INTO {destination}.blobs (hash, content)
+                SELECT hash, content FROM {source}.blobs
+                WHERE hash IN (SELECT blob_hash FROM {source}.messages WHERE chat_id {in_chats})""",
+            f"""INSERT INTO {destination}.messages ({MESSAGE_COLUMNS})
+                SELECT {MESSAGE_COLUMNS} FROM {source}.messages WHERE chat_id {in_chats}""",
+            f"""INSERT INTO {destination}.messages_fts (rowid, message_id, content)
+                SELECT rowid, message_id, content FROM {source}.messages_fts WHERE rowid {in_messages}""",
+            f"""INSERT INTO {destination}.chat_fts (rowid, chat_id, content)
+                SELECT rowid, chat_id, content FROM {source}.chat_fts WHERE chat_id {in_chats}""",
+            f"""INSERT INTO {destination}.chat_signatures (chat_id, signature)
+                SELECT chat_id, signature FROM {source}.chat_signatures WHERE chat_id {in_chats}""",
+        ]
+        if destination == "main" and self.substring_search:
+            queries += [
+                f"""INSERT INTO main.messages_trigram (rowid, message_id, content)
+                    SELECT rowid, message_id, content FROM main.messages_fts WHERE rowid {in_messages}""",
+                f"""INSERT INTO main.chat_trigram (rowid, chat_id, content)
+                    SELECT rowid, chat_id, content FROM main.chat_fts WHERE chat_id {in_chats}""",
+            ]
+        for query in queries:
+            self.conn.execute(query, (ids,))
+
+    def remove_chats(self, chat_ids, schema):
+        ids = json.dumps(chat_ids)
+        in_chats = "IN (SELECT value FROM json_each(?))"
+        in_messages = f"IN (SELECT id FROM {schema}.messages WHERE chat_id {in_chats})"
+        queries = [
+            f"DELETE FROM {schema}.messages_fts WHERE rowid {in_messages}",
+            f"DELETE FROM {schema}.chat_fts WHERE chat_id {in_chats}",
+        ]
+        if schema == "main" and self.substring_search:
+            queries += [
+                f"DELETE FROM main.messages_trigram WHERE rowid {in_messages}",
+                f"DELETE FROM main.chat_trigram WHERE chat_id {in_chats}",
+            ]
+        queries += [
+            f"DELETE FROM {schema}.messages WHERE chat_id {in_chats}",
+            f"DELETE FROM {schema}.chats WHERE id {in_chats}",
+        ]
+        for query in queries:
+            self.conn.execute(query, (ids,))
+
+    def needs_vacuum(self):
+        """True until the database is in incremental auto_vacuum mode."""
+        return self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2
+
+    def reclaim_space(self, full=False):
+        """
+        Returns free pages to the filesystem. Switching a database to
+        incremental mode takes one full VACUUM, which can take minutes on a
+        large one, so that's only done when full is True.
+        Returns a description of what was done.
+        """
+        with self.write_lock:
+            if not self.needs_vacuum():
+                self.conn.execute("PRAGMA incremental_vacuum")
+                return "done"
+            if not full:
+                return "skipped, needs a full vacuum"
+            self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self.conn.execute("VACUUM")
+            return "vacuumed"
+
+    def fts_tables(self, query):
+        """
+        Picks the indexes to search. A query that starts with ~ matches
+        substrings of at least three characters when substring search is
+        enabled; otherwise terms match whole words, or word prefixes when
+        they end in *.
+        Returns (query, messages table, chats table).
+        """
+        if query.startswith("~"):
+            query = query[1:]
+            if self.substring_search:
+                return query, "messages_trigram", "chat_trigram"
+        return query, "messages_fts", "chat_fts"
+
+    def fts_terms(self, query):
+        terms = []
+        for word in query.split(" "):
+            prefix = len(word) > 1 and word.endswith("*")
+            if prefix:
+                word = word[:-1]
+            if not word:
+                continue
+            escaped_word = word.replace('"', '""')
+            terms.append(f'"{escaped_word}"*' if prefix else f'"{escaped_word}"')
+        return terms
+
+    def tokenize_fts(self, query):
+        return " ".join(self.fts_terms(query))
+
+    def decode_pagination_token(self, pagination_token):
+        """
+        Search results are ordered by (bm25 rank, id). A pagination token
+        holds the key of the last result of the previous page; the next page
+        starts strictly after it.
+        """
         if pagination_token is None:
-            offset = 0
+            return None
+        rank, rowid = json.loads(pagination_token)
+        return (rank, rowid)
+
+    def encode_pagination_token(self, rank, rowid):
+        return json.dumps([rank, rowid])
+
+    def search_chats(self, query: str, pagination_token: Optional[str], limit: int):
+        """
+        Searches chats across the contents of messages.
+        Returns ([ChatSearchResult, ...], next pagination token)
+        """
+
+        query, _, chats = self.fts_tables(query)
+        terms = [term.lower() for term in self.fts_terms(query)]
+        if not terms:
+            return [], pagination_token
+
+        # A chat matches when every term appears somewhere in it, though not
+        # necessarily in the same message. It is ranked by, and the snippet
+        # comes from, its best-ranked message that contains any of the terms.
+        any_term = " OR ".join(terms)
+        every_term = " INTERSECT ".join([f"SELECT chat_id FROM {chats} WHERE content MATCH ?"] * len(terms))
+        parameters = [any_term, *terms]
+        after = self.decode_pagination_token(pagination_token)
+        if after is None:
+            keyset = ""
         else:
-            offset = pagination_token
+            keyset = "WHERE (best_rank, chat_id) > (?, ?)"
+            parameters.extend(after)
+        parameters.extend([limit, any_term])
+        fts_query = f"""
+            WITH best AS (
+                SELECT chat_id, rowid AS best_rowid, MIN(rank) AS best_rank
+                FROM {chats}
+                WHERE content MATCH ? AND chat_id IN ({every_term})
+                GROUP BY chat_id
+            ),
+            page AS (
+                SELECT chat_id, best_rowid, best_rank
+                FROM best
+                {keyset}
+                ORDER BY best_rank, chat_id
+                LIMIT ?
+            )
+            SELECT page.chat_id, chats.name, snippet({chats}, 1, '\ue000', '\ue001', '...', 16) AS snippet, page.best_rank
+            FROM {chats}
+            JOIN page ON {chats}.rowid = page.best_rowid
+            JOIN chats ON chats.id = page.chat_id
+            WHERE {chats}.content MATCH ?
+            ORDER BY page.best_rank, page.chat_id
+            """
 
-        parameters = (query.lower(), limit, offset)
-        result = self.conn.execute(fts_query, parameters)
+        rows = list(self.conn.execute(fts_query, parameters))
+        if not rows:
+            return [], pagination_token
+        results = [ChatSearchResult(chat_id, name, snippet) for chat_id, name, snippet, _rank in rows]
+        last_chat_id, _name, _snippet, last_rank = rows[-1]
+        return results, self.encode_pagination_token(last_rank, last_chat_id)
 
-        message_ids = []
-        chat_ids = []
-        snippets = {}
-        for row in result:
-            message_ids.append(int(row[0]))
-            snippets[int(row[0])] = row[2]
-            chat_ids.append(int(row[1]))
 
-        # Sort chat IDs
-        sorted_chat_ids = sorted(set(chat_ids))
+    def search_messages_in_chat(self, query: str, chat_id: int):
+        """Returns [(role, content, time, id, deleted), ...] of matching messages in chat_id."""
+        query, messages, _ = self.fts_tables(query)
+        query = self.tokenize_fts(query)
+        if not query:
+            return []
+        fts_query = f"""
+            SELECT role, {MESSAGE_CONTENT}, time, messages.id, deleted
+            FROM {messages}
+            JOIN messages ON {messages}.message_id = messages.id
+            LEFT JOIN blobs ON blobs.hash = messages.blob_hash
+            WHERE {messages}.content MATCH ? AND messages.chat_id=?
+            ORDER BY messages.id ASC
+        """
+
+        parameters = (query.lower(), chat_id)
+        return [(role, decode_content(content), *rest) for (role, content, *rest) in self.conn.execute(fts_query, parameters)]
 
-        messages_by_chat = []
-        for chat_id in sorted_chat_ids:
-            message_ids_for_chat = [(message_ids[i], snippets[message_ids[i]]) for i in range(len(message_ids)) if chat_ids[i] == chat_id]
-            messages_by_chat.append((chat_id, message_ids_for_chat))
+    def search_messages(self, query: str, pagination_token: Optional[str], limit: int):
+        """
+        Searches messages in all chats. Results are grouped by chat, best
+        match first.
+        Returns ([ChatMessagesSearchResult, ...], next pagination token)
+        """
+        query, messages, _ = self.fts_tables(query)
+        query = self.tokenize_fts(query)
+        if not query:
+            return [], pagination_token
 
-        # Determine the pagination token
-        next_offset = offset + limit
-        has_more_results = len(message_ids) > next_offset
-        pagination_token = next_offset if has_more_results else None
+        parameters = [query.lower()]
+        after = self.decode_pagination_token(pagination_token)
+        if after is None:
+            keyset = ""
+        else:
+            keyset = f"AND ({messages}.rank, {messages}.rowid) > (?, ?)"
+            parameters.extend(after)
+        parameters.append(limit)
+        fts_query = f"""
+            WITH page AS (
+                SELECT m.id, m.chat_id, m.role, m.time, m.deleted,
+                       snippet({messages}, 1, '\ue000', '\ue001', '...', 16) AS snippet,
+                       {messages}.rank AS rank, {messages}.rowid AS fts_rowid
+                FROM {messages}
+                JOIN messages m ON {messages}.message_id = m.id
+                WHERE {messages}.content MATCH ? {keyset}
+                ORDER BY {messages}.rank, {messages}.rowid
+                LIMIT ?
+            ),
+            last AS (
+                SELECT rank, fts_rowid FROM page ORDER BY rank DESC, fts_rowid DESC LIMIT 1
+            )
+            SELECT page.chat_id, chats.name,
+                   json_group_array(json_array(page.id, page.role, page.time, page.deleted, page.snippet)),
+                   (SELECT rank FROM last), (SELECT fts_rowid FROM last)
+            FROM page
+            JOIN chats ON chats.id = page.chat_id
+            GROUP BY page.chat_id
+            ORDER BY MIN(page.rank), page.chat_id
+        """
 
-        return messages_by_chat, offset + len(message_ids)
+        rows = list(self.conn.execute(fts_query, parameters))
+        if not rows:
+            return [], pagination_token
+        messages_by_chat = [
+                ChatMessagesSearchResult(chat_id, name, [MessageSearchResult(*m) for m in json.loads(matches)])
+                for chat_id, name, matches, _rank, _rowid in rows]
+        _chat_id, _name, _matches, last_rank, last_rowid = rows[0]
+        return messages_by_chat, self.encode_pagination_token(last_rank, last_rowid)
 
     def get_setting(self, name: str, default_value=None):
         query = "SELECT value FROM settings WHERE key = ?"
@@ -274,8 +1370,8 @@ class ChatDB:
     def set_setting(self, name: str, value):
         encoded_value = json.dumps(value)
         query = "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)"
-        self.conn.execute(query, (name, encoded_value))
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(query, (name, encoded_value))
 
     def get_kv(self, name: str, default_value=None):
         query = "SELECT value FROM kvs WHERE key = ?"
@@ -292,7 +1388,7 @@ class ChatDB:
     def set_kv(self, name: str, value):
         encoded_value = json.dumps(value)
         query = "INSERT OR REPLACE INTO kvs (key, value) VALUES (?, ?)"
-        self.conn.execute(query, (name, encoded_value))
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(query, (name, encoded_value))
 
 
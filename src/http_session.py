@@ -0,0 +1,23 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+# All outbound HTTP goes through one session so that connections to the
+# OpenAI API and to fetched sites are kept alive and reused across turns and
+# tool calls, rather than paying for DNS, TCP and TLS setup every time.
+# requests keeps a separate pool for each host.
+POOL_CONNECTIONS = 10
+# Connections kept open per host. Chat streaming, naming a chat in the
+# background and tool calls can overlap.
+POOL_MAXSIZE = 4
+# (connect, read) timeouts in seconds. The read timeout bounds the gap
+# between chunks of a streamed response, not the whole response.
+TIMEOUT = (10, 120)
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+SESSION = create_session()
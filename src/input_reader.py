@@ -1,7 +1,9 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
 from prompt_toolkit import PromptSession, print_formatted_text, Application
 from prompt_toolkit.application.current import get_app
 from prompt_toolkit.formatted_text import HTML, FormattedText
+from prompt_toolkit.input import create_input
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.keys import Keys
 from prompt_toolkit.layout.containers import Window
@@ -25,6 +27,7 @@ class UserInput:
     edit = False
     allow_execution = False
     settings = False
+    related = False
 
 @dataclass
 class Chat:
@@ -33,6 +36,38 @@ class Chat:
     last_update: str
     num_messages: int
 
+class TypeAhead:
+    """
+    Reads the keyboard while a reply streams in. ^C cancels the task doing
+    the streaming. Anything else typed is kept to prefill the next prompt.
+    """
+    def __init__(self, task):
+        self.task = task
+        self.text = ""
+        self.input = create_input()
+
+    def keys_ready(self):
+        for key_press in self.input.read_keys():
+            if key_press.key == Keys.ControlC:
+                self.task.cancel()
+            elif key_press.key in (Keys.Backspace, Keys.ControlH):
+                self.text = self.text[:-1]
+            elif key_press.key == Keys.ControlM:
+                self.text += "\n"
+            elif len(key_press.data) == 1 and key_press.data.isprintable():
+                self.text += key_press.data
+
+    @contextmanager
+    def listening(self):
+        with self.input.raw_mode(), self.input.attach(self.keys_ready):
+            yield
+
+    @contextmanager
+    def paused(self):
+        """Gives the terminal back, e.g. for a tool that asks for confirmation."""
+        with self.input.detach(), self.input.cooked_mode():
+            yield
+
 def usage(model, text):
     try:
         encoding = tiktoken.encoding_for_model(model)
@@ -41,13 +76,25 @@ def usage(model, text):
         return 0
 
 
-# Returns UserInput
-def read_input(chats, current_chat_name, have_any_messages, placeholder, allow_execution, used, max_tokens, model):
+# The prompt being shown, if any.
+active_session = None
+
+def refresh():
+    """Redraws the prompt, e.g. after a background job changed the chat name. Safe from any thread."""
+    session = active_session
+    if session is not None and session.app.is_running:
+        session.app.invalidate()
+
+# Returns UserInput. chat_name is called to get the current chat's name
+# whenever the toolbar is drawn.
+def read_input(chats, chat_name, have_any_messages, placeholder, allow_execution, used, max_tokens, model):
+    global active_session
     result = UserInput()
     tokens_typed = [0]
     result.allow_execution = allow_execution
 
     session = PromptSession()
+    active_session = session
 
     def update_tokens_typed(_):
         buffer = session.default_buffer
@@ -79,6 +126,7 @@ def read_input(chats, current_chat_name, have_any_messages, placeholder, allow_e
     EDIT = "$$$EDIT"
     TOGGLE_SETTING = "$$$TOGGLE_SETTING"
     SETTINGS = "$$$SETTINGS"
+    RELATED = "$$$RELATED"
 
     @kb.add(Keys.F2)
     def _(event):
@@ -120,6 +168,12 @@ def read_input(chats, current_chat_name, have_any_messages, placeholder, allow_e
         app = get_app()
         app.exit(result=SEARCH_THIS_CHAT)
 
+    if have_any_messages:
+        @kb.add(Keys.F9)
+        def _(event):
+            app = get_app()
+            app.exit(result=RELATED)
+
     @kb.add(Keys.F10)
     def _(event):
         app = get_app()
@@ -194,7 +248,7 @@ def read_input(chats, current_chat_name, have_any_messages, placeholder, allow_e
     try:
         while True:
             def bottom_toolbar():
-                text = f'[{html.escape(current_chat_name)}] <b>M-⏎</b>: Send  <b>F2</b>: Switch chat  <b>F3</b>: New chat  <b>F4</b>: Search'
+                text = f'[{html.escape(chat_name())}] <b>M-⏎</b>: Send  <b>F2</b>: Switch chat  <b>F3</b>: New chat  <b>F4</b>: Search'
                 if have_any_messages:
                     text += "  <b>F5</b>: Regenerate"
                     text += "  <b>F6</b>: Edit Last"
@@ -204,6 +258,7 @@ def read_input(chats, current_chat_name, have_any_messages, placeholder, allow_e
                     text += "  <b>F7</b>: Enable Execution"
                 if have_any_messages:
                     text += "  <b>F8</b>: Search Current Chat"
+                    text += "  <b>F9</b>: Related Chats"
                 text += "  <b>F10</b>: Settings"
                 text += "  "
                 total_used = used + tokens_typed[0]
@@ -252,6 +307,9 @@ def read_input(chats, current_chat_name, have_any_messages, placeholder, allow_e
             elif value == SETTINGS:
                 result.settings = True
                 return result
+            elif value == RELATED:
+                result.related = True
+                return result
             else:
                 result.text = value
                 return result
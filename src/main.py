@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 from dataclasses import dataclass
-from src.background_task import BackgroundTask
-from src.chat import create_chat, create_chat_with_spinner, suggest_name, invoke
-from src.db import ChatDB
+from src.backend import RecordingBackend, ReplayBackend, read_recording, set_backend
+from src.chat import StallError, StreamStats, WatchedChat, record_chat, replay_chat, response_cache_key, stream_chat, suggest_name, invoke_all, tool
+from src.db import ChatDB, ChatSearchResult, chat_fulltext, DEFAULT_PROFILE, PERFORMANCE_PROFILES
 from src.formatting import print_message
 from src.formatting import setMark
 from src.highlight import SyntaxHighlighter
-from src.input_reader import Chat, read_input, usage
+from src.http_session import SESSION, TIMEOUT
+from src.input_reader import Chat, TypeAhead, read_input, refresh, usage
 from prompt_toolkit import print_formatted_text
 from prompt_toolkit.formatted_text import HTML
+from src.related import RelatedChats
+from src.scheduler import Scheduler, HIGH, LOW
 from src.search import display_chat_search_results, display_search_results
 from src.spin import Spinner
+from src.transfer import export_jsonl, import_jsonl
 from src.ui_utils import draw_horizontal_line, draw_light_horizontal_line
+import argparse
+import asyncio
+from contextlib import aclosing
 import html
 import json
 from newspaper import Article
@@ -19,18 +26,24 @@ import openai
 import os
 import subprocess
 import sys
+import tempfile
+import time
 import tiktoken
 import traceback
 from typing import Optional, Any, Callable
-import requests
 from html2text import html2text
 
-openai.api_key = os.environ.get("OPENAI_API_KEY")
-if not openai.api_key:
-    openai.api_key = os.environ.get("OPENAI_KEY")
-if not openai.api_key:
-    print("Set the environment variable OPENAI_KEY or OPENAI_API_KEY to your api secret key")
-    exit(1)
+def configure_api_key():
+    openai.requestssession = SESSION
+    openai.api_key = os.environ.get("OPENAI_API_KEY")
+    if not openai.api_key:
+        openai.api_key = os.environ.get("OPENAI_KEY")
+    if not openai.api_key:
+        print("Set the environment variable OPENAI_KEY or OPENAI_API_KEY to your api secret key")
+        exit(1)
+
+# Names of tools offered to the model when execution is enabled.
+EXECUTION_TOOLS = ("execute_command", "create_file", "execute_python", "fetch_web_page", "summarize_web_page")
 
 @dataclass
 class Setting:
@@ -52,30 +65,39 @@ def str_to_bool(s):
     raise Exception("Boolean values must be 'true' or 'false'")
 
 class App:
-    def __init__(self):
-        self.tasks = []
-        self.chat_db = ChatDB()
+    def __init__(self, chat_db=None):
+        self.scheduler = Scheduler()
+        self.chat_db = chat_db or ChatDB()
+        self.related_chats = RelatedChats(self.chat_db)
+        summarize_web_page.app = self
         self.current_chat_id = None
+        self.current_chat_name = "New chat"
         self.messages = []
         self.placeholder = ""
         self.allow_execution = False
         self.temperature = 0
         self.chats = []
         self.chat = None
+        self.chat_cache_key = None
+        self.stream_stats = StreamStats()
         self.content = None
         self.max_tokens = 8000
         self.load_settings()
         self.print_settings()
+        # Archive first so the related chats index isn't built with chats
+        # that are about to leave this database.
+        self.archive_old_chats()
         self.index_all_chats()
 
     def new_chat(self):
-        self.current_chat_id = self.chat_db.create_chat("New chat")
-        self.messages.clear()
-        self.messages.append({
-            "role": "system",
-            "content": "You assist a user in a terminal emulator."})
-        self.chat_db.add_message(self.current_chat_id, self.messages[0]["role"],
-                self.messages[0]["content"], None, None)
+        with self.chat_db.transaction():
+            self.current_chat_id = self.chat_db.create_chat("New chat")
+            self.messages.clear()
+            self.messages.append({
+                "role": "system",
+                "content": "You assist a user in a terminal emulator."})
+            self.chat_db.add_message(self.current_chat_id, self.messages[0]["role"],
+                    self.messages[0]["content"], None, None)
         return self.current_chat_id
 
     def run_forever(self):
@@ -83,7 +105,7 @@ class App:
             self.iterate()
 
     def delete_until_user_message(self):
-         while self.messages[-1]["role"] == "assistant" or self.messages[-1]["role"] == "function" or "function_call" in self.messages[-1]:
+         while self.messages[-1]["role"] == "assistant" or self.messages[-1]["role"] in ("function", "tool") or "function_call" in self.messages[-1]:
              self.chat_db.delete_message(self.messages[-1]["id"])
              self.messages = self.messages[:-1]
 
@@ -91,8 +113,8 @@ class App:
         self.temperature = 0
         self.chats = list(map(lambda x: Chat(*x), self.chat_db.list_chats()))
         setMark()
-        current_chat_name = self.get_chat_name()
-        user_input = self.read(current_chat_name)
+        self.current_chat_name = self.get_chat_name()
+        user_input = self.read()
         self.placeholder = ""
         if not user_input:
             # Empty query means to quit.
@@ -110,6 +132,12 @@ class App:
             self.edit()
             return True
         message = user_input.text
+        if user_input.related:
+            new_i = self.show_related()
+            if new_i is not None:
+                user_input.chat_identifier = new_i
+            else:
+                return True
         if user_input.query:
             new_i = self.search(user_input.query)
             if new_i is not None:
@@ -133,19 +161,20 @@ class App:
         if len(self.messages) == 1:
             self.assign_name(message)
 
-        self.send_message(message)
+        # Everything written during the turn is committed at once, after
+        # it ends.
+        with self.chat_db.write_behind():
+            asyncio.run(self.send_message(message))
         return True
 
-    def send_message(self, message):
+    async def send_message(self, message):
         draw_light_horizontal_line()
         setMark()
 
         self.messages.append(
             {"role": "user", "content": message},
         )
-        message_id = self.chat_db.add_message(self.current_chat_id, "user", message, None, None)
-        self.update_chat_fulltext()
-        self.messages[-1]["id"] = message_id
+        self.save_message(self.messages[-1])
         sanitized = [
                 {k: v for k, v in message.items() if k != 'id'} 
                 for message in self.messages]
@@ -159,40 +188,35 @@ class App:
                 print_formatted_text(HTML(f'<em>Warning: token limit exceeded. {truncated} message{s} dropped.</em>'))
 
         if self.allow_execution:
-            execute_command.sloppy = False
-            create_file.sloppy = False
-            execute_python.sloppy = True
-            fetch_web_page.sloppy = True
-            functions = [execute_command, create_file, execute_python, fetch_web_page, summarize_web_page]
-            summarize_web_page.app = self
+            functions = EXECUTION_TOOLS
             if os.environ.get("AZURE_KEY"):
-                functions.append(bing_search)
+                functions += ("bing_search",)
         else:
-            functions = []
-        try:
-            self.chat = create_chat_with_spinner(sanitized, self.temperature, functions, self.model)
-        except Exception as e:
-            print(f"Failed to create chat: {e}")
-            return
+            functions = ()
         self.content = ""
         sh = SyntaxHighlighter()
-        fspinner = None
+        # The reply streams in on its own task so that the keyboard stays
+        # live: ^C cancels the task and anything else typed is kept for the
+        # next prompt.
+        reply = asyncio.create_task(self.read_responses(sanitized, functions, sh))
+        self.type_ahead = TypeAhead(reply)
         try:
-            # There can be more than one chat when there's a function call.
-            while self.read_response(functions, sh):
-                pass
+            with self.type_ahead.listening():
+                if not await reply:
+                    return
             sh.eof()
             print("")
             print("")
-        except KeyboardInterrupt:
+        except asyncio.CancelledError:
             sh.eof()
-            self.chat.close()
             print("")
+        finally:
+            self.placeholder = self.type_ahead.text
+            stats = self.stream_stats
+            self.chat_db.defer(lambda: self.chat_db.record_stream_stats(stats))
+            self.stream_stats = StreamStats()
         self.commit_ordinary()
 
-        # Check if any tasks are done.
-        self.check_tasks()
-
     def set_model(self, model):
         self.model = model
 
@@ -218,11 +242,77 @@ class App:
                     lambda s: self.set_auto_truncate(s),
                     True,
                     lambda: self.auto_truncate,
+                    lambda s: str_to_bool(s)),
+                Setting(
+                    "Substring search (prefix a search with ~)",
+                    "substring-search",
+                    lambda s: self.set_substring_search(s),
+                    False,
+                    lambda: self.chat_db.substring_search,
+                    lambda s: str_to_bool(s)),
+                Setting(
+                    "Archive chats after this many days (0 for never)",
+                    "archive-after-days",
+                    lambda s: self.set_archive_after_days(s),
+                    0,
+                    lambda: self.archive_after_days,
+                    lambda s: self.validate_archive_after_days(s)),
+                Setting(
+                    "Database profile (" + ", ".join(PERFORMANCE_PROFILES) + ")",
+                    "database-profile",
+                    lambda s: self.set_database_profile(s),
+                    DEFAULT_PROFILE,
+                    lambda: self.database_profile,
+                    lambda s: self.validate_database_profile(s)),
+                Setting(
+                    "Response cache (replay answers to repeated prompts)",
+                    "response-cache",
+                    lambda s: self.set_response_cache(s),
+                    False,
+                    lambda: self.response_cache,
                     lambda s: str_to_bool(s))]
 
+    def set_response_cache(self, value):
+        self.response_cache = value
+
     def set_auto_truncate(self, value):
         self.auto_truncate = value
 
+    def set_database_profile(self, value):
+        self.database_profile = value
+        self.chat_db.load_performance_profile()
+
+    def validate_database_profile(self, value):
+        if value not in PERFORMANCE_PROFILES:
+            raise Exception("Unknown profile")
+        return value
+
+    def set_archive_after_days(self, value):
+        self.archive_after_days = value
+
+    def validate_archive_after_days(self, value):
+        days = int(value)
+        if days < 0:
+            raise Exception("The number of days can't be negative")
+        return days
+
+    def archive_old_chats(self):
+        if not self.archive_after_days:
+            return
+        n = self.chat_db.archive_chats(self.archive_after_days)
+        if n:
+            self.related_chats.reset()
+            s = "s" if n != 1 else ""
+            print(f"Moved {n} chat{s} older than {self.archive_after_days} days to the archive.")
+            if self.chat_db.needs_vacuum():
+                print("Run gptline maintain to return the space they used to the filesystem.")
+
+    def set_substring_search(self, value):
+        try:
+            self.chat_db.set_substring_search(value)
+        except Exception as e:
+            print(f"Substring search is unavailable: {e}")
+
     def load_settings(self):
         for setting in self.settings():
             setting.load(self.chat_db.get_setting(setting.key, setting.default))
@@ -259,27 +349,17 @@ class App:
             print("Cancel")
             return
 
-    def check_tasks(self):
-        for task in self.tasks:
-            if task.done():
-                if not task.exception:
-                    maybeTuple = task.result()
-                    if maybeTuple is not None:
-                      (chat_id, name) = maybeTuple
-                      self.chat_db.set_chat_name(chat_id, name)
-        self.tasks = [task for task in self.tasks if not task.done()]
-
     def get_chat_name(self):
         if self.current_chat_id is None:
             return "New chat"
         else:
             return self.chat_db.get_chat_name(self.current_chat_id)
 
-    def read(self, current_chat_name):
+    def read(self):
         try:
             user_input = read_input(
                     self.chats,
-                    current_chat_name,
+                    lambda: self.current_chat_name,
                     len(self.messages) > 1,
                     self.placeholder,
                     self.allow_execution,
@@ -290,13 +370,14 @@ class App:
             return user_input 
         except KeyboardInterrupt:
             print("^C")
+            self.scheduler.shutdown(timeout=5)
             exit(0)
 
     def message_content(self, message):
         c = message["content"]
         if c is not None:
             return c
-        f = message["function_call"]
+        f = message.get("function_call") or message.get("tool_calls")
         if f is not None:
             return json.dumps(f)
         return 0
@@ -309,52 +390,78 @@ class App:
 
     def regenerate(self):
         print("Regenerating response...")
-        self.delete_until_user_message()
-        text = self.messages[-1]["content"]
-        self.temperature = 0.5
-        self.chat_db.delete_message(self.messages[-1]["id"])
-        self.messages = self.messages[:-1]
+        with self.chat_db.transaction():
+            self.delete_until_user_message()
+            text = self.messages[-1]["content"]
+            self.temperature = 0.5
+            self.chat_db.delete_message(self.messages[-1]["id"])
+            self.messages = self.messages[:-1]
         return text
 
     def edit(self):
         print("Editing previous message...")
-        self.delete_until_user_message()
-        self.placeholder = self.messages[-1]["content"]
-        self.chat_db.delete_message(self.messages[-1]["id"])
-        self.messages = self.messages[:-1]
+        with self.chat_db.transaction():
+            self.delete_until_user_message()
+            self.placeholder = self.messages[-1]["content"]
+            self.chat_db.delete_message(self.messages[-1]["id"])
+            self.messages = self.messages[:-1]
 
     def search_messages(self, query):
         """Search messages in the current chat"""
         results = self.chat_db.search_messages_in_chat(query, self.current_chat_id)
         i = 1
-        for message_id in results:
+        for (role, content, timestamp, mid, deleted) in results:
             draw_light_horizontal_line()
             print_formatted_text(HTML(f'<b>Message {i} of {len(results)}</b>'))
             i += 1
-            role, content, timestamp, mid, deleted = self.chat_db.get_message_by_id(message_id)
             print_message(timestamp, role, content, deleted)
             print("")
 
     def search(self, query):
         """Returns id of chat to switch to or else None.
-        A negative id means to create a new chat."""
+        A negative id means to create a new chat. Once results from the
+        database run out, the archive is searched too. Picking an archived
+        chat restores it."""
         i = None
         cursor = None
         PAGE_SIZE = 10
+        chat_db = self.chat_db
         while True:
-            search_results, cursor = self.chat_db.search_chats(query, cursor, PAGE_SIZE)
+            search_results, cursor = chat_db.search_chats(query, cursor, PAGE_SIZE)
             if not len(search_results):
+                if chat_db is self.chat_db and self.chat_db.archive():
+                    chat_db = self.chat_db.archive()
+                    cursor = None
+                    print_formatted_text(HTML('<b>Archived chats:</b>'))
+                    continue
                 print("No results")
                 return None
-            i = display_chat_search_results(query, search_results, self.chat_db)
+            i = display_chat_search_results(query, search_results)
             if i is None:
-                cursor += PAGE_SIZE
                 continue
             if i < 0:
                 return -1
+            if chat_db is not self.chat_db:
+                self.chat_db.restore_chat(i)
+                self.related_chats.reset()
             return i
 
 
+    def show_related(self):
+        """Returns id of a chat similar to the current one to switch to or else None."""
+        related = self.related_chats.related(self.current_chat_id)
+        # Chats archived since the index was loaded are left out.
+        names = self.chat_db.get_chat_names([chat_id for (chat_id, _) in related])
+        results = [ChatSearchResult(chat_id, names[chat_id] or "", f"{score:.0%} similar")
+                   for (chat_id, score) in related if chat_id in names]
+        if not results:
+            print("No related chats")
+            return None
+        i = display_chat_search_results("", results)
+        if i is None or i < 0:
+            return None
+        return i
+
     def search_by_message(self, query):
         i = None
         cursor = None
@@ -364,9 +471,8 @@ class App:
             if not len(search_results):
                 print("No results")
                 return None
-            i = display_search_results(query, search_results, self.chat_db)
+            i = display_search_results(query, search_results)
             if i is None:
-                cursor += PAGE_SIZE
                 continue
             if i < 0:
                 return -1
@@ -376,10 +482,11 @@ class App:
         """Replace self.messages with contents of chat_id and also print the
         messages to the screen. As a side-effect, set self.current_chat_id."""
         self.current_chat_id = chat_id
-        n = self.chat_db.num_messages(self.current_chat_id)
         self.messages = []
-        for i in range(1, n):
-            (role, self.content, time, message_id, deleted, fname, fargs) = self.chat_db.get_message_by_index(self.current_chat_id, i)
+        rows = self.chat_db.get_messages(self.current_chat_id)
+        # Skip the system message.
+        next(rows, None)
+        for (role, self.content, time, message_id, deleted, fname, fargs, tool_call_id, tool_calls) in rows:
             if self.content is not None:
                 m = {
                     "id": message_id,
@@ -388,6 +495,8 @@ class App:
                     }
                 if role == "function":
                     m["name"] = fname
+                elif role == "tool":
+                    m["tool_call_id"] = tool_call_id
                 else:
                     if show:
                         if role == "user":
@@ -405,55 +514,103 @@ class App:
                     "function_call": {
                         "name": fname,
                         "arguments": fargs}})
+            elif tool_calls:
+                self.messages.append({
+                    "id": message_id,
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": json.loads(tool_calls)})
 
     def assign_name(self, message):
         # The chat needs a name
-        self.tasks.append(BackgroundTask(lambda: suggest_name(self.current_chat_id, message)))
-
-    def handle_function_call(self, functions, fspinner, call_name, call_args):
+        chat_id = self.current_chat_id
+        def name_chat():
+            maybeTuple = suggest_name(chat_id, message)
+            if maybeTuple is not None:
+                self.chat_db.set_chat_name(*maybeTuple)
+            return maybeTuple
+        def show_name(job):
+            # Update the toolbar right away rather than at the next prompt.
+            if job.result is not None and job.result[0] == self.current_chat_id:
+                self.current_chat_name = job.result[1]
+                refresh()
+        self.scheduler.submit(name_chat, HIGH, deadline=60, on_done=show_name)
+
+    async def read_responses(self, sanitized, functions, sh):
+        """Returns False if the chat couldn't be created."""
         try:
-            if fspinner:
-                fspinner.stop()
-            return (None, invoke(functions, call_name, call_args), None)
+            await self.create_chat(sanitized, functions, True)
         except Exception as e:
-            return (None, None, str(e))
+            print(f"Failed to create chat: {e}")
+            return False
+        # There can be more than one chat when there's a function call.
+        while await self.read_response(functions, sh):
+            pass
+        return True
+
+    async def create_chat(self, sanitized, functions, spinner=False):
+        """Sets self.chat to an async iterator over the chunks of a new
+        stream, which is retried if it stalls. With the response cache on, a
+        deterministic request is replayed if it was made before and
+        otherwise recorded."""
+        self.chat_cache_key = None
+        if self.response_cache and self.temperature == 0:
+            key = response_cache_key(self.model, sanitized, functions)
+            cached = self.chat_db.get_cached_response(key)
+            if cached is not None:
+                self.chat = stream_chat(replay_chat(cached))
+                return
+            self.chat_cache_key = key
+        chat = WatchedChat(sanitized, self.temperature, functions, self.model, self.stream_stats)
+        await chat.connect(spinner)
+        self.chat = chat.chunks()
+
+    async def handle_tool_calls(self, functions, fspinner, tool_calls):
+        """Runs the calls in tool_calls. Returns (spinner, [(output, error), ...])."""
+        if fspinner:
+            fspinner.stop()
+        calls = [(call["function"]["name"], call["function"]["arguments"]) for call in tool_calls.values()]
+        return (None, await invoke_all(functions, calls, self.type_ahead.paused))
 
     def stop_unexpectedly(self, finish_reason):
         print("")
         print(f"Stopping because {finish_reason}")
 
-    def read_response(self, functions, sh):
+    async def read_response(self, functions, sh):
         """Read an entire response and handle it. Return True to call this again."""
         fspinner = None
         try:
-            call_name = None
-            call_args = None
-            function_output = None
-            error_output = None
-            for resp in self.chat:
-                if resp.choices[0].finish_reason:
-                    finish_reason = resp.choices[0].finish_reason
-                    if finish_reason == "function_call" and call_name and call_args:
-                        fspinner, function_output, error_output = self.handle_function_call(
-                                functions,
-                                fspinner,
-                                call_name,
-                                call_args)
-                    elif finish_reason != "stop":
-                        self.stop_unexpectedly(finish_reason)
-                    break
-                elif "content" in resp.choices[0].delta and resp.choices[0].delta.content:
-                    self.content = self.handle_content(resp, self.content, sh)
-                elif "function_call" in resp.choices[0].delta and resp.choices[0].delta.function_call and self.allow_execution:
-                    call_name, call_args, fspinner = self.accrue_function_call(
-                            resp, call_name, call_args, fspinner)
-
-
-            return self.commit_special(
-                    call_name,
-                    call_args,
-                    function_output,
-                    error_output,
+            # Calls being streamed in, by index.
+            tool_calls = {}
+            results = None
+            chunks = self.chat
+            if self.chat_cache_key:
+                key = self.chat_cache_key
+                chunks = record_chat(chunks, lambda recorded: self.chat_db.defer(
+                    lambda: self.chat_db.set_cached_response(key, recorded)))
+            try:
+                async with aclosing(chunks) as chunks:
+                    async for resp in chunks:
+                        if resp.choices[0].finish_reason:
+                            finish_reason = resp.choices[0].finish_reason
+                            if finish_reason == "tool_calls" and tool_calls:
+                                fspinner, results = await self.handle_tool_calls(
+                                        functions,
+                                        fspinner,
+                                        tool_calls)
+                            elif finish_reason != "stop":
+                                self.stop_unexpectedly(finish_reason)
+                            break
+                        elif "content" in resp.choices[0].delta and resp.choices[0].delta.content:
+                            self.content = self.handle_content(resp, self.content, sh)
+                        elif "tool_calls" in resp.choices[0].delta and resp.choices[0].delta.tool_calls and self.allow_execution:
+                            fspinner = self.accrue_tool_calls(resp, tool_calls, fspinner)
+            except StallError as e:
+                self.stop_unexpectedly(e)
+
+            return await self.commit_special(
+                    tool_calls,
+                    results,
                     functions)
         finally:
             if fspinner:
@@ -466,141 +623,218 @@ class App:
         sh.put(chunk)
         return content
 
-    def accrue_function_call(self, resp, call_name, call_args, fspinner):
-        if "name" in resp.choices[0].delta.function_call:
-            if call_name:
-                call_name += resp.choices[0].delta.function_call.name
-            else:
+    def accrue_tool_calls(self, resp, tool_calls, fspinner):
+        """Adds a chunk of one or more tool calls to tool_calls. Returns the spinner."""
+        for delta in resp.choices[0].delta.tool_calls:
+            if not tool_calls:
                 fspinner = Spinner()
-                call_name = resp.choices[0].delta.function_call.name
-        if "arguments" in resp.choices[0].delta.function_call:
-            if call_args:
-                call_args += resp.choices[0].delta.function_call.arguments
-            else:
-                call_args = resp.choices[0].delta.function_call.arguments
-        return (call_name, call_args, fspinner)
+            call = tool_calls.setdefault(delta.index, {
+                "id": "",
+                "type": "function",
+                "function": {"name": "", "arguments": ""}})
+            if delta.get("id"):
+                call["id"] += delta.id
+            function = delta.get("function") or {}
+            if function.get("name"):
+                call["function"]["name"] += function.name
+            if function.get("arguments"):
+                call["function"]["arguments"] += function.arguments
+        return fspinner
 
     def index_all_chats(self):
-        if self.chat_db.get_kv("chat_fts_migration") == "done":
+        """Rebuilds the chat index in the background if needed and then
+        prefetches the related chats index, which is built from it."""
+        prefetch = lambda job=None: self.scheduler.submit(self.related_chats.load, LOW)
+        if not self.chat_db.needs_chat_reindex():
+            prefetch()
             return
-        print("Re-indexing all chats for better full text search. This could take a second.")
-        saved = self.current_chat_id
-        for info in self.chat_db.list_chats():
-            cid = info[0]
-            self.switch(cid, False)
-            self.update_chat_fulltext()
-        self.current_chat_id = saved
-        print("Done")
-        self.chat_db.set_kv("chat_fts_migration", "done")
-
-    def update_chat_fulltext(self):
-        content = self.get_chat_name() + "\n" + "\n".join([self.plaintext_message(m) for m in self.messages])
-        self.chat_db.set_chat_fulltext(self.current_chat_id, content)
+        print("Re-indexing all chats in the background for better full text search. Until it finishes, search may miss older chats.")
+        def index():
+            for _ in self.chat_db.reindex_chats():
+                if self.scheduler.stopping.is_set():
+                    return
+        self.scheduler.submit(index, LOW, on_done=prefetch)
+
+    def save_message(self, m, tool_call_id=None, tool_calls=None, index=True):
+        """Writes m, a message of the current chat, when the turn's writes
+        are flushed. Its ID is set then."""
+        chat_id = self.current_chat_id
+        def write():
+            m["id"] = self.chat_db.add_message(chat_id, m["role"], m["content"], None, None, tool_call_id, tool_calls)
+            if index:
+                self.update_chat_fulltext(chat_id, m)
+        self.chat_db.defer(write)
+
+    def update_chat_fulltext(self, chat_id, m):
+        """Add a message to its chat's chat-level index."""
+        text = self.plaintext_message(m)
+        if text:
+            self.chat_db.add_chat_fulltext(chat_id, m["id"], text)
+            self.related_chats.add_text(chat_id, text)
 
     def plaintext_message(self, m):
-        if m["role"] == "assistant":
-            role = "Assistant"
-        elif m["role"] == "user":
-            role = "User"
-        else:
-            return ""
-        if "content" not in m:
-            return ""
-        content = m["content"]
-        return f'{role}: {content}'
-
-    def commit_special(self, call_name, call_args, function_output,
-            error_output, functions):
-        if call_name and call_args:
-            self.commit_function_call_request(call_name, call_args);
-        if function_output:
-            self.commit_function_output(functions, call_name, function_output)
+        return chat_fulltext(m["role"], m.get("content"))
+
+    async def commit_special(self, tool_calls, results, functions):
+        # Calls are only recorded along with their results, since the API
+        # rejects a request for tool calls that isn't followed by them.
+        if tool_calls and results is not None:
+            self.commit_tool_calls_request(list(tool_calls.values()))
+            await self.commit_tool_results(functions, list(tool_calls.values()), results)
             return True
-        if error_output:
-            return self.commit_error(error_output, functions)
         return False
 
     def commit_ordinary(self):
         if self.content is not None:
             self.messages.append({"role": "assistant", "content": self.content})
-        message_id = self.chat_db.add_message(
-                self.current_chat_id,
-                self.messages[-1]["role"],
-                self.messages[-1]["content"],
-                None,
-                None)
-        self.messages[-1]["id"] = message_id
-        self.update_chat_fulltext()
-
-    def commit_function_call_request(self, call_name, call_args):
-        # Record that a function call was requested
+        self.save_message(self.messages[-1])
+
+    def commit_tool_calls_request(self, tool_calls):
+        # Record that tool calls were requested. They're kept as JSON.
         self.messages.append({
             "role": "assistant",
             "content": None,
-            "function_call": {
-                "name": call_name,
-                "arguments": call_args}})
-        message_id = self.chat_db.add_message(self.current_chat_id,
-                self.messages[-1]["role"], self.messages[-1]["content"], call_name, call_args)
-        self.messages[-1]["id"] = message_id
-        self.update_chat_fulltext()
-
-    def commit_function_output(self, functions, call_name, function_output):
-        # Record the output of the function call
-        self.messages.append({
-            "role": "function",
-            "name": call_name,
-            "content": function_output})
-        message_id = self.chat_db.add_message(
-                self.current_chat_id,
-                self.messages[-1]["role"],
-                self.messages[-1]["content"],
-                call_name,
-                None)
-        self.messages[-1]["id"] = message_id
+            "tool_calls": tool_calls})
+        self.save_message(self.messages[-1], tool_calls=json.dumps(tool_calls))
+
+    async def commit_tool_results(self, functions, tool_calls, results):
+        # Record the output of each call with its ID. They all go back to
+        # the model in one request.
+        for (call, (output, error)) in zip(tool_calls, results):
+            if error is not None:
+                print(f'Error: {error}')
+                output = f"Error: {error}"
+            self.messages.append({
+                "role": "tool",
+                "tool_call_id": call["id"],
+                "content": output if output is not None else ""})
+            self.save_message(self.messages[-1], tool_call_id=call["id"], index=False)
         sanitized = [
                 {k: v for k, v in message.items() if k != 'id'} 
                 for message in self.messages]
         try:
-            self.chat = create_chat(sanitized, self.temperature, functions, self.model)
+            await self.create_chat(sanitized, functions)
         except Exception as e:
             print(f"Failed to create chat: {e}")
 
-    def commit_error(self, error_output, functions):
-        # Something went wrong
-        print(f'Error: {error_output}')
-        auto_retry = False
-        self.messages.append({
-            "role": "system",
-            "content": error_output})
-        message_id = self.chat_db.add_message(
-                self.current_chat_id,
-                self.messages[-1]["role"],
-                self.messages[-1]["content"],
-                None,
-                None)
-        self.messages[-1]["id"] = message_id
-        if auto_retry:
-            sanitized = [
-                    {k: v for k, v in message.items() if k != 'id'} 
-                    for message in self.messages]
-            print(sanitized)
-            try:
-                self.chat = create_chat(sanitized, self.temperature, functions, self.model)
-            except Exception as e:
-                print(f"Failed to create chat: {e}")
-                return False
-            return True
-        else:
-            print(f"An error was encountered while executing a function: {error_output}")
-            self.content = None
-            return False
+def reindex(chat_db, restart=False):
+    for (done, total, num_messages, seconds) in chat_db.reindex_chats(restart=restart):
+        rate = num_messages / seconds if seconds else 0
+        print(f"\r{done} of {total} chats, {num_messages} messages ({rate:.0f}/s)", end="")
+    print("")
+    print("Done")
+
+def bench(path):
+    """
+    Replays each recorded turn that used no tools, as fast as possible and
+    into a scratch database, and reports how long the client took.
+    """
+    set_backend(ReplayBackend(path, realtime=False))
+    directory = tempfile.mkdtemp()
+    chat_db = ChatDB(os.path.join(directory, "bench.db"), os.path.join(directory, "bench-archive.db"))
+    # The scratch database is empty, so there's nothing to reindex. Let the
+    # background jobs App starts finish before timing anything.
+    chat_db.set_kv("chat_fts_migration", "incremental")
+    app = App(chat_db)
+    app.scheduler.wait_idle()
+    times = []
+    num_chunks = 0
+    for (request, chunks) in read_recording(path):
+        messages = request["messages"]
+        if not request.get("stream") or "tools" in request or messages[-1]["role"] != "user":
+            continue
+        app.model = request["model"]
+        app.temperature = request["temperature"]
+        app.current_chat_id = app.chat_db.create_chat("Benchmark")
+        app.messages = [dict(m) for m in messages[:-1]]
+        start = time.perf_counter()
+        with app.chat_db.write_behind():
+            asyncio.run(app.send_message(messages[-1]["content"]))
+        times.append(time.perf_counter() - start)
+        num_chunks += len(chunks)
+    app.scheduler.shutdown(timeout=5)
+    if not times:
+        print("No replayable turns in the recording")
+        return
+    times.sort()
+    percentile = lambda p: times[min(len(times) - 1, int(p * len(times)))]
+    print(f"{len(times)} turns, {num_chunks} chunks")
+    print(f"Per turn: median {percentile(0.5) * 1000:.1f}ms, p90 {percentile(0.9) * 1000:.1f}ms, max {times[-1] * 1000:.1f}ms")
+    print(f"{num_chunks / sum(times):.0f} chunks/s")
 
 def main():
+    parser = argparse.ArgumentParser(prog="gptline")
+    parser.add_argument("--record", metavar="FILE", help="Append every chat API response to FILE, for --replay")
+    parser.add_argument("--replay", metavar="FILE", help="Answer chat API requests from a file written by --record instead of the network")
+    parser.add_argument("--fast", action="store_true", help="With --replay, send responses as fast as possible rather than with their recorded timing")
+    subparsers = parser.add_subparsers(dest="command")
+    export_parser = subparsers.add_parser("export", help="Write all chats, including archived ones, to a JSONL file")
+    export_parser.add_argument("file", nargs="?", default="-", help="Output file, or - for stdout")
+    import_parser = subparsers.add_parser("import", help="Add chats from a JSONL file made by export")
+    import_parser.add_argument("file", nargs="?", default="-", help="Input file, or - for stdin")
+    compact_parser = subparsers.add_parser("compact", help="Permanently remove deleted messages and shrink the search indexes")
+    compact_parser.add_argument("--days", type=int, default=30, help="Only remove messages at least this many days old")
+    subparsers.add_parser("maintain", help="Analyze, merge search indexes, reclaim free space, checkpoint the WAL and check integrity")
+    subparsers.add_parser("reindex", help="Rebuild the chat search index from scratch")
+    bench_parser = subparsers.add_parser("bench", help="Replay recorded turns as fast as possible and time the client's own work")
+    bench_parser.add_argument("file", help="A file written by --record")
+    subparsers.add_parser("latency", help="Show time to first token and stall statistics")
+    cache_parser = subparsers.add_parser("cache", help="Show response cache statistics")
+    cache_parser.add_argument("--clear", action="store_true", help="Remove all cached responses and reset the statistics")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_jsonl(ChatDB(), args.file)
+        return
+    if args.command == "import":
+        import_jsonl(ChatDB(), args.file)
+        return
+    if args.command == "compact":
+        n = ChatDB().compact(args.days)
+        print(f"Removed {n} deleted messages")
+        return
+    if args.command == "reindex":
+        reindex(ChatDB(), restart=True)
+        return
+    if args.command == "maintain":
+        for (step, seconds, result) in ChatDB().maintain():
+            print(f"{step}: {result} ({seconds:.2f}s)")
+        return
+
+    if args.command == "latency":
+        stats = ChatDB().get_stream_stats()
+        print(f"{stats['requests']} requests, {stats['stalls']} stalls, {stats['retries']} retries")
+        ttfts = sorted(stats["ttfts"])
+        if ttfts:
+            percentile = lambda p: ttfts[min(len(ttfts) - 1, int(p * len(ttfts)))]
+            print(f"Time to first token over the last {len(ttfts)}: "
+                  f"median {percentile(0.5):.2f}s, p90 {percentile(0.9):.2f}s, max {ttfts[-1]:.2f}s")
+        return
+    if args.command == "cache":
+        chat_db = ChatDB()
+        if args.clear:
+            chat_db.clear_response_cache()
+        (count, size, hits, misses) = chat_db.response_cache_stats()
+        print(f"{count} responses, {size / 1024:.0f} KiB")
+        rate = hits / (hits + misses) if hits + misses else 0
+        print(f"{hits} hits, {misses} misses ({rate:.0%} hit rate)")
+        return
+
+    if args.command == "bench":
+        bench(args.file)
+        return
+
+    if args.replay:
+        set_backend(ReplayBackend(args.replay, realtime=not args.fast))
+    else:
+        configure_api_key()
+        if args.record:
+            set_backend(RecordingBackend(args.record))
     print("Welcome to gptline! Enter a question and press option-Enter to send it.")
     app = App()
     app.run_forever()
 
+@tool()
 def execute_command(command_line: str, input_string: str):
     """
     Executes a unix command at the shell. Note that it does not run in a TTY so interactive commands will not work.
@@ -630,6 +864,7 @@ def execute_command(command_line: str, input_string: str):
         print(f'Exception while executing provided code: {e}')
         return str(e)
 
+@tool()
 def create_file(name: str, content: str):
     """
     Creates a file with the given name and contents.
@@ -659,6 +894,7 @@ def create_file(name: str, content: str):
     except Exception as e:
         return f"Error creating file: {str(e)}"
 
+@tool(sloppy=True)
 def execute_python(code: str, input_string: Optional[str]):
     """
     Executes python code. Outputs values from stdout. If you need a computed value make sure to print() it.
@@ -696,6 +932,7 @@ def execute_python(code: str, input_string: Optional[str]):
     except Exception as e:
         return f"Error: {str(e)}"
 
+@tool(sloppy=True, parallel=True)
 def fetch_web_page(url: str):
     """
     Load a web page. Convert it to markdown and return. If something goes wrong, return a string like "404 error while fetching {url}".
@@ -708,7 +945,11 @@ def fetch_web_page(url: str):
 
 def do_fetch(url):
     article = Article(url)
-    article.download()
+    # Download through the shared session rather than newspaper's own
+    # requests call so the connection can be reused.
+    response = SESSION.get(url, headers={"User-Agent": article.config.browser_user_agent}, timeout=TIMEOUT)
+    response.raise_for_status()
+    article.download(input_html=response.text)
     article.parse()
     text = article.text
     if text:
@@ -717,6 +958,7 @@ def do_fetch(url):
     return markdown_content
 
 
+@tool(parallel=True)
 def bing_search(query: str):
     """
     Perform a web search. Returns a markdown document with search results.
@@ -730,12 +972,13 @@ def bing_search(query: str):
     search_term = query
     headers = {"Ocp-Apim-Subscription-Key": subscription_key}
     params = {"q": search_term, "textDecorations": True, "textFormat": "HTML"}
-    response = requests.get(search_url, headers=headers, params=params)
+    response = SESSION.get(search_url, headers=headers, params=params, timeout=TIMEOUT)
     response.raise_for_status()
     search_results = response.json()
     values = [f' * [{v["url"]}]({v["snippet"]})' for v in search_results["webPages"]["value"]]
     return "\n".join(values)
 
+@tool(parallel=True)
 def summarize_web_page(url: str):
     """
     Load and summarizes a web page. Returns an English summary of the web page's contents.
@@ -0,0 +1,124 @@
+import numpy as np
+import re
+import threading
+import zlib
+
+# Each chat is summarized by a MinHash signature of the set of words in it:
+# for each of NUM_HASHES hash functions, the smallest hash of any of its
+# words. The fraction of positions where two signatures agree estimates the
+# Jaccard similarity of the chats' vocabularies. Adding text to a chat can
+# only lower the values, so signatures are updated in place as messages
+# arrive.
+NUM_HASHES = 128
+PRIME = (1 << 31) - 1
+_random = np.random.default_rng(1337)
+HASH_A = _random.integers(1, PRIME, NUM_HASHES, dtype=np.uint64)
+HASH_B = _random.integers(0, PRIME, NUM_HASHES, dtype=np.uint64)
+EMPTY_SIGNATURE = np.full(NUM_HASHES, PRIME, dtype=np.uint32)
+
+WORD = re.compile(r"\w{4,}")
+STOP_WORDS = {"that", "this", "with", "have", "from", "they", "will", "would", "there",
+              "their", "what", "about", "which", "when", "your", "more", "some", "than",
+              "then", "them", "these", "into", "only", "also", "just", "like", "user",
+              "assistant"}
+
+def signature(text):
+    words = set(WORD.findall(text.lower())) - STOP_WORDS
+    if not words:
+        return EMPTY_SIGNATURE.copy()
+    hashes = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), dtype=np.uint64, count=len(words)) % PRIME
+    return ((hashes[:, None] * HASH_A + HASH_B) % PRIME).min(axis=0).astype(np.uint32)
+
+def decode_signature(blob):
+    return np.frombuffer(blob, dtype=np.uint32)
+
+class RelatedChats:
+    """
+    Finds chats with similar vocabulary without any network calls.
+    Signatures are stored in ChatDB and held in memory as one matrix once
+    the first query is made. Safe to load from a background thread.
+    """
+    def __init__(self, chat_db):
+        self.chat_db = chat_db
+        self.chat_ids = None
+        self.signatures = None
+        self.rows = {}
+        # Guards the in-memory matrix. Never held while writing to chat_db.
+        self.lock = threading.Lock()
+
+    def add_text(self, chat_id, text):
+        """Folds text into chat_id's signature."""
+        new_signature = signature(text)
+        old_signature = self.chat_db.get_chat_signature(chat_id)
+        if old_signature is not None:
+            new_signature = np.minimum(new_signature, decode_signature(old_signature))
+        self.chat_db.set_chat_signature(chat_id, new_signature.tobytes())
+        with self.lock:
+            if self.signatures is None:
+                return
+            row = self.rows.get(chat_id)
+            if row is None:
+                self.rows[chat_id] = len(self.chat_ids)
+                self.chat_ids = np.append(self.chat_ids, chat_id)
+                self.signatures = np.vstack([self.signatures, new_signature])
+            else:
+                self.signatures[row] = new_signature
+
+    def build(self, batch_size=500):
+        """
+        Computes signatures for chats that don't have one yet from their
+        indexed text. A chat with no text gets EMPTY_SIGNATURE, which
+        matches nothing.
+        """
+        last_chat_id = 0
+        while True:
+            (chat_ids, rows) = self.chat_db.get_unsigned_chat_fulltext(last_chat_id, batch_size)
+            if not chat_ids:
+                break
+            last_chat_id = chat_ids[-1]
+            texts = {}
+            for (chat_id, text) in rows:
+                texts.setdefault(chat_id, []).append(text)
+            batch = [(chat_id, np.minimum.reduce([signature(text) for text in texts.get(chat_id, [""])]))
+                     for chat_id in chat_ids]
+            with self.chat_db.transaction():
+                for (chat_id, chat_signature) in batch:
+                    self.chat_db.set_chat_signature(chat_id, chat_signature.tobytes())
+
+    def load(self):
+        if self.signatures is not None:
+            return
+        self.build()
+        with self.lock:
+            if self.signatures is not None:
+                return
+            chat_ids = []
+            blobs = []
+            for (chat_id, blob) in self.chat_db.get_chat_signatures():
+                chat_ids.append(chat_id)
+                blobs.append(blob)
+            self.chat_ids = np.array(chat_ids, dtype=np.int64)
+            self.signatures = np.frombuffer(b"".join(blobs), dtype=np.uint32).reshape(-1, NUM_HASHES).copy()
+            self.rows = {chat_id: row for (row, chat_id) in enumerate(chat_ids)}
+
+    def reset(self):
+        """Drops the in-memory matrix so the next query reloads it."""
+        with self.lock:
+            self.chat_ids = None
+            self.signatures = None
+            self.rows = {}
+
+    def related(self, chat_id, limit=10):
+        """Returns [(chat ID, similarity), ...] for the chats most similar to chat_id, best first."""
+        self.load()
+        with self.lock:
+            row = self.rows.get(chat_id)
+            if row is None or (self.signatures[row] == EMPTY_SIGNATURE).all():
+                return []
+            scores = (self.signatures == self.signatures[row]).mean(axis=1)
+            chat_ids = self.chat_ids
+        scores[row] = 0
+        limit = min(limit, len(scores))
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        best = best[np.argsort(-scores[best])]
+        return [(int(chat_ids[i]), float(scores[i])) for i in best if scores[i] > 0]
@@ -0,0 +1,125 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+import traceback
+
+# Lower numbers run first.
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+class Job:
+    """A function submitted to a Scheduler, and eventually its outcome."""
+    def __init__(self, func, priority, deadline, on_done):
+        self.func = func
+        self.priority = priority
+        self.deadline = deadline
+        self.on_done = on_done
+        self.result = None
+        self.exception = None
+        self.cancelled = False
+        self._done = threading.Event()
+
+    def cancel(self):
+        """Keeps the job from starting. A job that's already running finishes."""
+        self.cancelled = True
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Returns True if the job finished within timeout seconds."""
+        return self._done.wait(timeout)
+
+class Scheduler:
+    """
+    Runs jobs on a fixed pool of worker threads, highest priority first and
+    in submission order within a priority.
+    """
+    def __init__(self, num_workers=2):
+        self.queue = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        # Jobs taken off the queue that haven't finished yet.
+        self.running = 0
+        # Long-running jobs should check this and return early when it's set.
+        self.stopping = threading.Event()
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, func, priority=NORMAL, deadline=None, on_done=None):
+        """
+        Queues func to run with no arguments. If deadline is given and the job
+        hasn't started that many seconds from now, it's dropped with a
+        TimeoutError. on_done(job) is called on the worker thread once the job
+        finishes, fails, is cancelled or misses its deadline. For a job that
+        shutdown cancels, or one submitted after it, on_done is called on the
+        thread that calls shutdown or submit.
+        """
+        job = Job(func, priority, time.monotonic() + deadline if deadline is not None else None, on_done)
+        with self.condition:
+            if not self.stopping.is_set():
+                heapq.heappush(self.queue, (priority, next(self.sequence), job))
+                self.condition.notify()
+                return job
+        job.cancel()
+        self._finish(job)
+        return job
+
+    def _next_job(self):
+        with self.condition:
+            while not self.queue and not self.stopping.is_set():
+                self.condition.wait()
+            if self.stopping.is_set():
+                return None
+            self.running += 1
+            return heapq.heappop(self.queue)[2]
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            if not job.cancelled:
+                if job.deadline is not None and time.monotonic() > job.deadline:
+                    job.exception = TimeoutError("Job missed its deadline")
+                else:
+                    try:
+                        job.result = job.func()
+                    except Exception as e:
+                        job.exception = e
+            self._finish(job)
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Waits up to timeout seconds for the queue to empty and every job to finish. Returns True if it did."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queue and not self.running, timeout)
+
+    def _finish(self, job):
+        job._done.set()
+        if job.on_done:
+            try:
+                job.on_done(job)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+        elif job.exception and not isinstance(job.exception, TimeoutError):
+            traceback.print_exception(job.exception, file=sys.stderr)
+
+    def shutdown(self, timeout=None):
+        """Cancels queued jobs and waits up to timeout seconds for running ones."""
+        with self.condition:
+            self.stopping.set()
+            queued = [job for (_, _, job) in self.queue]
+            self.queue = []
+            self.condition.notify_all()
+        for job in queued:
+            job.cancel()
+            self._finish(job)
+        for worker in self.workers:
+            worker.join(timeout)
@@ -3,14 +3,13 @@ from prompt_toolkit.formatted_text import HTML
 from src.formatting import print_snippet
 import html
 
-def display_chat_search_results(query, search_results, chat_db):
+def display_chat_search_results(query, search_results):
     session = PromptSession()
 
     while True:
-        for index, (chat_id, snippet) in enumerate(search_results, start=1):
-            chat_name = chat_db.get_chat_name(chat_id)
-            print_formatted_text(HTML(f'<b>{index}. {html.escape(chat_name)}</b>'))
-            escaped_snippet = html.escape(snippet).replace('\ue000', '<b>').replace('\ue001', '</b>').replace('\n', ' ')
+        for index, result in enumerate(search_results, start=1):
+            print_formatted_text(HTML(f'<b>{index}. {html.escape(result.name)}</b>'))
+            escaped_snippet = html.escape(result.snippet).replace('\ue000', '<b>').replace('\ue001', '</b>').replace('\n', ' ')
             print_formatted_text(HTML("    " + escaped_snippet))
 
         # Prompt the user to either select a chat or request more results
@@ -31,7 +30,7 @@ def display_chat_search_results(query, search_results, chat_db):
         try:
             selected_index = int(user_input) - 1
             if 0 <= selected_index < len(search_results):
-                selected_chat_id = search_results[selected_index][0]
+                selected_chat_id = search_results[selected_index].chat_id
                 return selected_chat_id
             else:
                 print("Invalid input. Please enter a valid number.")
@@ -40,17 +39,15 @@ def display_chat_search_results(query, search_results, chat_db):
 
 
 
-def display_search_results(query, messages_by_chat, chat_db):
+def display_search_results(query, messages_by_chat):
     session = PromptSession()
 
     while True:
-        for index, (chat_id, message_ids) in enumerate(messages_by_chat, start=1):
-            chat_name = chat_db.get_chat_name(chat_id)
-            print_formatted_text(HTML(f'<b>{index}. {html.escape(chat_name)}</b>'))
-            for (message_id, snippet) in message_ids:
-                role, content, timestamp, _id, deleted = chat_db.get_message_by_id(message_id)
-                escaped_snippet = html.escape(snippet).replace('\ue000', '<b>').replace('\ue001', '</b>').replace('\n', ' ')
-                print_snippet(timestamp, role, escaped_snippet, deleted, "    ")
+        for index, chat in enumerate(messages_by_chat, start=1):
+            print_formatted_text(HTML(f'<b>{index}. {html.escape(chat.name)}</b>'))
+            for message in chat.messages:
+                escaped_snippet = html.escape(message.snippet).replace('\ue000', '<b>').replace('\ue001', '</b>').replace('\n', ' ')
+                print_snippet(message.time, message.role, escaped_snippet, message.deleted, "    ")
 
         # Prompt the user to either select a chat or request more results
         try:
@@ -70,7 +67,7 @@ def display_search_results(query, messages_by_chat, chat_db):
         try:
             selected_index = int(user_input) - 1
             if 0 <= selected_index < len(messages_by_chat):
-                selected_chat_id = messages_by_chat[selected_index][0]
+                selected_chat_id = messages_by_chat[selected_index].chat_id
                 return selected_chat_id
             else:
                 print("Invalid input. Please enter a valid number.")
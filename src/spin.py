@@ -1,3 +1,4 @@
+import asyncio
 import sys
 import threading
 import time
@@ -41,3 +42,30 @@ def spin(f):
         raise exc
     return result
 
+
+async def spin_async(awaitable):
+    """
+    Like spin, for an awaitable. The spinner runs on the event loop, so it
+    stops as soon as the awaitable finishes, fails or is cancelled.
+    """
+    wrote = False
+    async def run():
+        nonlocal wrote
+        bs = ""
+        spinner = ["|", "/", "-", "\\"]
+        i = 0
+        while True:
+            sys.stdout.write(bs + spinner[i % 4])
+            bs = chr(8)
+            sys.stdout.flush()
+            wrote = True
+            await asyncio.sleep(0.1)
+            i += 1
+    task = asyncio.create_task(run())
+    try:
+        return await awaitable
+    finally:
+        task.cancel()
+        if wrote:
+            sys.stdout.write(chr(8) + " " + chr(8))
+            sys.stdout.flush()
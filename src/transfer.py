@@ -0,0 +1,33 @@
+import json
+import sys
+import time
+
+def export_jsonl(chat_db, path):
+    """Writes every chat and its messages to path, one JSON object per line."""
+    start = time.time()
+    n = 0
+    output = sys.stdout if path == "-" else open(path, "w")
+    try:
+        for record in chat_db.export_records():
+            output.write(json.dumps(record) + "\n")
+            n += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"Exported {n} records in {time.time() - start:.1f}s", file=sys.stderr)
+
+def read_jsonl(input):
+    for line in input:
+        if line.strip():
+            yield json.loads(line)
+
+def import_jsonl(chat_db, path):
+    """Adds the chats in a file written by export_jsonl."""
+    start = time.time()
+    input = sys.stdin if path == "-" else open(path)
+    try:
+        num_chats, num_messages = chat_db.import_records(read_jsonl(input))
+    finally:
+        if input is not sys.stdin:
+            input.close()
+    print(f"Imported {num_chats} chats with {num_messages} messages in {time.time() - start:.1f}s", file=sys.stderr)
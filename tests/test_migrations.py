@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from src.db import MIGRATIONS, ChatDB, migrate, schema_version
+
+# The schema written by gptline before migrations were introduced.
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE chats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        last_update TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        role TEXT,
+        content TEXT NULL,
+        time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        deleted INTEGER DEFAULT 0,
+        function_call_name TEXT,
+        function_call_arguments TEXT,
+        FOREIGN KEY (chat_id) REFERENCES chats (id)
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE messages_fts USING FTS5 (
+        message_id UNINDEXED,
+        content,
+        content_rowid,
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE chat_fts USING FTS5 (
+        chat_id UNINDEXED,
+        content
+    )
+    """,
+    "CREATE TABLE settings (key TEXT NOT NULL UNIQUE, value TEXT NOT NULL)",
+    "CREATE TABLE kvs (key TEXT NOT NULL UNIQUE, value TEXT NOT NULL)",
+]
+
+LARGE = "The same fetched web page, over and over. " * 200
+
+class BaselineMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "baseline.db")
+        conn = sqlite3.connect(self.path)
+        for query in BASELINE_SCHEMA:
+            conn.execute(query)
+        conn.execute("INSERT INTO chats (id, name) VALUES (1, 'Fetching')")
+        # Like the baseline's add_message: function output isn't indexed, so
+        # messages_fts rowids fall behind message IDs.
+        messages = [
+            (1, "system", "You assist a user in a terminal emulator.", None, None, 0),
+            (2, "assistant", None, "fetch_web_page", '{"url": "https://example.com"}', 0),
+            (3, "function", LARGE, "fetch_web_page", None, 0),
+            (4, "function", LARGE, "fetch_web_page", None, 0),
+            (5, "user", "summarize it", None, None, 0),
+            (6, "assistant", "It repeats itself.", None, None, 1),
+        ]
+        for (message_id, role, content, name, arguments, deleted) in messages:
+            conn.execute(
+                    "INSERT INTO messages (id, chat_id, role, content, function_call_name, function_call_arguments, deleted) VALUES (?, 1, ?, ?, ?, ?, ?)",
+                    (message_id, role, content, name, arguments, deleted))
+            if content is not None and role != "function":
+                conn.execute("INSERT INTO messages_fts (message_id, content) VALUES (?, ?)", (message_id, content.lower()))
+        conn.execute("INSERT INTO chat_fts (chat_id, content) VALUES (1, 'User: summarize it')")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_migrates_to_latest_version(self):
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(schema_version(conn), 0)
+        self.assertEqual(migrate(conn), len(MIGRATIONS))
+        # Running again is a no-op.
+        self.assertEqual(migrate(conn), len(MIGRATIONS))
+
+        self.assertEqual(conn.execute("SELECT num_messages FROM chat_summaries WHERE chat_id = 1").fetchone(), (6,))
+
+        # Both copies of the large body share one blob.
+        self.assertEqual(conn.execute("SELECT COUNT(*), MAX(refcount) FROM blobs").fetchone(), (1, 2))
+        rows = conn.execute("SELECT id FROM messages WHERE content IS NULL AND blob_hash IS NOT NULL ORDER BY id").fetchall()
+        self.assertEqual(rows, [(3,), (4,)])
+
+        # messages_fts is keyed by message ID and the deleted message is gone.
+        rows = conn.execute("SELECT rowid, message_id FROM messages_fts ORDER BY rowid").fetchall()
+        self.assertEqual(rows, [(1, 1), (5, 5)])
+
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+        self.assertIn("tool_call_id", columns)
+        self.assertIn("tool_calls", columns)
+        conn.close()
+
+    def test_migrated_database_reads_back(self):
+        chat_db = ChatDB(self.path, None)
+        messages = list(chat_db.get_messages(1))
+        self.assertEqual([m[1] for m in messages[2:4]], [LARGE, LARGE])
+        self.assertEqual(messages[1][5:7], ("fetch_web_page", '{"url": "https://example.com"}'))
+        self.assertEqual([m[4] for m in chat_db.search_messages_in_chat("summarize", 1)], [0])
+        self.assertEqual(chat_db.search_messages_in_chat("repeats", 1), [])
+
+if __name__ == "__main__":
+    unittest.main()